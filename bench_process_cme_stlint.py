@@ -0,0 +1,232 @@
+# Benchmark process_cme_stlint stages on synthetic stlint files, no CME FTP needed
+
+# Standards
+import sys
+import os
+import json
+import time
+import random
+import datetime
+import tempfile
+import tracemalloc
+
+# Locals
+from tz_interface import tz_cme
+from tz_script import process_cme_stlint
+
+################## CONSTANTS #######################################################################
+
+# Roughly one real settlement day at scale 1
+BASE_FUTURES_MONTHS = 40
+BASE_OPTION_MONTHS = 8
+BASE_STRIKES = 60
+
+SCALES = [1, 10, 100]
+
+STAGES = ['parse', 'transform', 'write']
+
+# A stage slower than the last saved run by more than this is reported as a regression
+REGRESSION_TOLERANCE = 0.20
+
+BENCH_RESULTS_PATH = os.path.join(os.path.expanduser('~'), 'tz_data', 'bench',
+                                  'process_cme_stlint.jsonl')
+
+STLINT_MONTHS = list(tz_cme.cme_stlint_month_dic.keys())
+
+################## FUNCTIONS: SYNTHETIC DATA #######################################################
+
+
+def contract_month(i):
+
+    # i-th consecutive contract month from JAN17.  Ex: 8 gives SEP17
+    return '%s%02d' % (STLINT_MONTHS[i % 12], (17 + i // 12) % 100)
+
+
+def settle_row(first_token, rnd):
+
+    # first token, open, high, low, last, settle, change, volume, prior settle, prior vol, prior oi
+    # Settles under 1 are written by CME without the leading 0.  Ex: .0150
+    settle = '%.4f' % (rnd.randrange(1, 400) * 0.0025)
+    settle = settle[1:] if settle.startswith('0.') else settle
+    return '%s  ---- ---- ---- ---- %s +.0025 %d %s 0 %d' % (first_token, settle,
+                                                               rnd.randrange(10000), settle,
+                                                               rnd.randrange(100000))
+
+
+def iter_synthetic_stlint(scale=1, seed=0):
+
+    # Yields the lines of a synthetic stlint laid out like CME's: a dated header, the ED futures
+    # section, then one CALL and one PUT section per option product and month, each closed by
+    # a TOTAL line
+    rnd = random.Random(seed)
+
+    business_date = datetime.date.today().strftime('%m/%d/%y')
+
+    yield 'CME GROUP SETTLEMENT PRICES   BUSINESS DATE: %s' % business_date
+    yield ''
+
+    option_prods = [p for p in tz_cme.cme_stlint_lst if p != 'ED']
+
+    yield 'ED EURODOLLAR FUTURES'
+    for i in range(BASE_FUTURES_MONTHS * scale):
+        yield settle_row(contract_month(i), rnd)
+    yield 'TOTAL EURODOLLAR FUTURES %d' % rnd.randrange(1000000)
+    yield ''
+
+    strikes = [int(9500 + 12.5 * k) for k in range(BASE_STRIKES)]
+
+    for prod in option_prods:
+        for i in range(BASE_OPTION_MONTHS * scale):
+            for cp in ['CALL', 'PUT']:
+
+                yield '%s %s EURODOLLAR OPTIONS %s' % (prod, contract_month(i), cp)
+
+                for strike in strikes:
+                    yield settle_row(str(strike), rnd)
+
+                yield 'TOTAL %s %d' % (prod, rnd.randrange(100000))
+                yield ''
+
+
+def write_synthetic_stlint(stlint_path, scale=1, seed=0):
+
+    n_lines = 0
+
+    with open(stlint_path, 'w') as f:
+        for line in iter_synthetic_stlint(scale, seed):
+            f.write(line + '\n')
+            n_lines += 1
+
+    return n_lines
+
+################## FUNCTIONS: BENCHMARK ############################################################
+
+
+def run_stages(stlint_path, output_path):
+
+    # Runs parse, transform and write once, returning seconds per stage
+
+    timings = {}
+
+    start = time.perf_counter()
+    settle_df = process_cme_stlint.load_stlint(stlint_path)
+    timings['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    settles_df = process_cme_stlint.transform_settles(settle_df)
+    timings['transform'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    process_cme_stlint.write_settles(settles_df, output_path)
+    timings['write'] = time.perf_counter() - start
+
+    return timings
+
+
+def peak_memory(stlint_path, output_path):
+
+    # Peak traced allocation of the whole pipeline, run separately since tracing slows it down
+    tracemalloc.start()
+
+    try:
+        run_stages(stlint_path, output_path)
+        return tracemalloc.get_traced_memory()[1]
+
+    finally:
+        tracemalloc.stop()
+
+
+def bench_scale(scale, repeats=3):
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        stlint_path = os.path.join(tmp_dir, 'stlint')
+        output_path = os.path.join(tmp_dir, 'settles.txt')
+
+        n_lines = write_synthetic_stlint(stlint_path, scale)
+
+        # best of the repeats per stage
+        runs = [run_stages(stlint_path, output_path) for _ in range(repeats)]
+        timings = {stage: min(r[stage] for r in runs) for stage in STAGES}
+
+        peak_bytes = peak_memory(stlint_path, output_path)
+
+    total = sum(timings.values())
+
+    return {'scale': scale,
+            'lines': n_lines,
+            'stage_seconds': timings,
+            'total_seconds': total,
+            'lines_per_second': n_lines / total,
+            'peak_mb': peak_bytes / 1e6}
+
+
+def last_results(results_path=BENCH_RESULTS_PATH):
+
+    # Most recently saved result per scale
+
+    previous = {}
+
+    if os.path.isfile(results_path):
+        with open(results_path, 'r') as f:
+            for line in f:
+                result = json.loads(line)
+                previous[result['scale']] = result
+
+    return previous
+
+
+def report(result, previous=None):
+
+    print('%4dx %9d lines  %10.0f lines/s  peak %7.1f MB  %s' %
+          (result['scale'], result['lines'], result['lines_per_second'], result['peak_mb'],
+           '  '.join('%s %.3fs' % (s, result['stage_seconds'][s]) for s in STAGES)))
+
+    if previous is None:
+        return
+
+    for stage in STAGES:
+
+        before = previous['stage_seconds'][stage]
+        after = result['stage_seconds'][stage]
+
+        if before > 0 and after > before * (1 + REGRESSION_TOLERANCE):
+            print('      REGRESSION: %s %.3fs -> %.3fs (%+.0f%%) since %s' %
+                  (stage, before, after, 100 * (after / before - 1), previous['label']))
+
+
+def run(scales, label, results_path=BENCH_RESULTS_PATH):
+
+    previous = last_results(results_path)
+
+    if not os.path.isdir(os.path.dirname(results_path)):
+        os.makedirs(os.path.dirname(results_path))
+
+    for scale in scales:
+
+        result = bench_scale(scale)
+        result['label'] = label
+        result['timestamp'] = datetime.datetime.now().isoformat()
+
+        report(result, previous.get(scale))
+
+        with open(results_path, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+    print('Results saved to %s' % results_path)
+
+####################################################################################################
+################## SCRIPT START ####################################################################
+####################################################################################################
+
+if __name__ == '__main__':
+
+    # python -m tz_script.bench_process_cme_stlint [label] [scale ...]
+    script_label = datetime.datetime.now().strftime('%Y_%m_%d_%H%M')
+
+    if len(sys.argv) > 1:
+        script_label = sys.argv[1]
+
+    script_scales = [int(s) for s in sys.argv[2:]] or SCALES
+
+    run(script_scales, script_label)
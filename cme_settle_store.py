@@ -0,0 +1,263 @@
+# Date-indexed local history of parsed CME settles, one memory-mappable partition per trade date
+
+# Standards
+import sys
+import os
+import re
+import glob
+import json
+import shutil
+import datetime
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+# Locals
+from tz_interface import tz_cme
+
+################## CONSTANTS #######################################################################
+
+SETTLE_STORE_DIR = os.path.join(os.path.expanduser('~'), 'tz_data', 'cme_settles')
+
+DATE_DIR_FMT = '%Y%m%d'
+
+META_FILE_NAME = 'meta.json'
+
+# stlint headers carry the business date.  Ex: 10/17/26
+HEADER_DATE_RE = re.compile(r'\b(\d{2})/(\d{2})/(\d{2}(?:\d{2})?)\b')
+HEADER_LINES_TO_SCAN = 10
+
+################## FUNCTIONS: WRITE ################################################################
+
+
+def stlint_trade_date(stlint_path):
+
+    # Trade date from the stlint header, falling back to the file's modified date
+
+    with open(stlint_path, 'r') as f:
+        for _, line in zip(range(HEADER_LINES_TO_SCAN), f):
+
+            match = HEADER_DATE_RE.search(line)
+
+            if match:
+                month, day, year = match.groups()
+                year_fmt = '%Y' if len(year) == 4 else '%y'
+                return datetime.datetime.strptime(month + day + year, '%m%d' + year_fmt).date()
+
+    return datetime.date.fromtimestamp(os.path.getmtime(stlint_path))
+
+
+def write_day(trade_date, settle_df, store_dir=SETTLE_STORE_DIR):
+
+    # Writes the day's settlement table as one .npy file per column, rows grouped by product so
+    # a product's settles are one contiguous slice.  Rewriting a day replaces it (final settles
+    # replace preliminary ones).
+
+    day_dir = os.path.join(store_dir, trade_date.strftime(DATE_DIR_FMT))
+
+    # a temp dir of its own, so writes of the same day never share one
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(day_dir) + '.tmp', dir=store_dir)
+
+    settle_df = settle_df.sort_values('Prod', kind='mergesort')  # stable, keeps file order
+
+    # settles are kept as written in stlint by the parser, stored here as numbers
+    settle_df = settle_df.assign(Price=pd.to_numeric(settle_df['Price'].astype(str),
+                                                     errors='coerce'))
+    prods = settle_df['Prod'].astype(str).values
+
+    meta = {'n_rows': len(settle_df),
+            'columns': [str(col) for col in settle_df.columns],
+            'categories': {},
+            'prod_slices': {}}
+
+    for col in settle_df.columns:
+
+        values = settle_df[col]
+
+        # categoricals are stored as their integer codes
+        if str(values.dtype) == 'category':
+            meta['categories'][col] = [str(c) for c in values.cat.categories]
+            values = values.cat.codes
+
+        np.save(os.path.join(tmp_dir, col + '.npy'), values.values)
+
+    starts = np.flatnonzero(np.r_[True, prods[1:] != prods[:-1]]) if len(prods) else []
+
+    for start, stop in zip(starts, list(starts[1:]) + [len(prods)]):
+        meta['prod_slices'][prods[start]] = [int(start), int(stop)]
+
+    with open(os.path.join(tmp_dir, META_FILE_NAME), 'w') as f:
+        json.dump(meta, f)
+
+    # the day's old settles move aside rather than being deleted, so readers only miss the day
+    # between two renames and a failed swap puts them back
+    old_dir = tmp_dir + '.old'
+
+    try:
+        os.rename(day_dir, old_dir)
+    except FileNotFoundError:
+        old_dir = None
+
+    try:
+        os.rename(tmp_dir, day_dir)
+
+    except OSError:
+        if old_dir is not None:
+            os.rename(old_dir, day_dir)
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    return day_dir
+
+################## FUNCTIONS: READ #################################################################
+
+
+def trade_dates(store_dir=SETTLE_STORE_DIR):
+
+    # Sorted trade dates held in the store
+
+    dates = []
+
+    for name in os.listdir(store_dir) if os.path.isdir(store_dir) else []:
+
+        try:
+            dates.append(datetime.datetime.strptime(name, DATE_DIR_FMT).date())
+        except ValueError:
+            continue  # temp and other dirs
+
+    return sorted(dates)
+
+
+def query_settles(start_date, end_date, prods=None, strike=None, cp=None,
+                  store_dir=SETTLE_STORE_DIR):
+
+    # Settles from start_date to end_date inclusive, optionally for a list of products (stlint or
+    # Happ codes, Ex: E0 or S), one stlint strike and a call/put ('C' or 'P').  Columns are
+    # memory-mapped so only the selected product slices are read from disk.
+
+    if prods is not None:
+        prods = [tz_cme.o_ed_midcurve.get(p, p) for p in prods]
+
+    frames = []
+
+    for trade_date in trade_dates(store_dir):
+
+        if not (start_date <= trade_date <= end_date):
+            continue
+
+        day_dir = os.path.join(store_dir, trade_date.strftime(DATE_DIR_FMT))
+
+        with open(os.path.join(day_dir, META_FILE_NAME), 'r') as f:
+            meta = json.load(f)
+
+        if meta['n_rows'] == 0:
+            continue
+
+        if prods is None:
+            slices = [(0, meta['n_rows'])]
+        else:
+            slices = [meta['prod_slices'][p] for p in prods if p in meta['prod_slices']]
+
+        if len(slices) == 0:
+            continue
+
+        cols = {col: np.load(os.path.join(day_dir, col + '.npy'), mmap_mode='r')
+                for col in meta['columns']}
+
+        for start, stop in slices:
+
+            keep = np.ones(stop - start, dtype=bool)
+
+            if strike is not None:
+                keep &= cols['Strike'][start:stop] == strike
+
+            if cp is not None:
+                keep &= cols['CP'][start:stop] == ord(cp)
+
+            if not keep.any():
+                continue
+
+            day_df = pd.DataFrame({col: np.asarray(cols[col][start:stop])[keep]
+                                   for col in meta['columns']},
+                                  columns=meta['columns'])
+
+            for col, categories in meta['categories'].items():
+                day_df[col] = pd.Categorical.from_codes(day_df[col], categories)
+
+            day_df.insert(0, 'TradeDate', trade_date)
+            frames.append(day_df)
+
+    if len(frames) == 0:
+        return pd.DataFrame()
+
+    return pd.concat(frames, ignore_index=True)
+
+################## FUNCTIONS: BACKFILL #############################################################
+
+
+def backfill_file(stlint_path, store_dir=SETTLE_STORE_DIR):
+
+    # Parses one archived stlint into the store, runs in a worker process
+    from tz_script.process_cme_stlint import load_stlint
+
+    trade_date = stlint_trade_date(stlint_path)
+    settle_df = load_stlint(stlint_path)
+
+    write_day(trade_date, settle_df, store_dir)
+
+    return stlint_path, trade_date, len(settle_df)
+
+
+def backfill(archive_dir, file_pattern='*stlint*', store_dir=SETTLE_STORE_DIR, max_workers=None):
+
+    # Parses every archived stlint in archive_dir into the store, one file per process.  Files
+    # are grouped by trade date first and only the last modified of each date is parsed, so
+    # final settles replace preliminary ones whatever order the workers finish in.
+
+    latest_paths = {}
+
+    for stlint_path in sorted(glob.glob(os.path.join(archive_dir, file_pattern)),
+                              key=lambda path: (os.path.getmtime(path), path)):
+
+        trade_date = stlint_trade_date(stlint_path)
+
+        if trade_date in latest_paths:
+            print('%s: %s replaces %s' % (trade_date, os.path.basename(stlint_path),
+                                          os.path.basename(latest_paths[trade_date])))
+
+        latest_paths[trade_date] = stlint_path
+
+    stlint_paths = [latest_paths[trade_date] for trade_date in sorted(latest_paths)]
+    print('Backfilling %d stlint files into %s' % (len(stlint_paths), store_dir))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+
+        for stlint_path, trade_date, n_rows in executor.map(backfill_file, stlint_paths,
+                                                            [store_dir] * len(stlint_paths)):
+
+            print('%s: %d settles from %s' % (trade_date, n_rows, os.path.basename(stlint_path)))
+
+    print('COMPLETED: backfill')
+
+####################################################################################################
+################## SCRIPT START ####################################################################
+####################################################################################################
+
+if __name__ == '__main__':
+
+    # python -m tz_script.cme_settle_store backfill <archive_dir> [file_pattern]
+    if len(sys.argv) >= 3 and sys.argv[1] == 'backfill':
+        backfill(*sys.argv[2:4])
+
+    else:
+        print('usage: python -m tz_script.cme_settle_store backfill <archive_dir> [file_pattern]')
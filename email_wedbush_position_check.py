@@ -1,11 +1,19 @@
 # Standards
 import sys
 import os
+import glob
+import hashlib
 import pandas as pd
 import datetime
+import time
+import ftplib
+import queue
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # Locals
 from tz_interface import tz_dropbox, tz_files, tz_gmail, tz_clearing
+from tz_script import position_recon
 
 ############### CONSTANTS ##########################################################################
 
@@ -17,6 +25,43 @@ SUB_DT_FMT = "%a, %m/%d/%Y, %I:%M %p"
 TITLE_NEW = 'NEW, NEWS, EXP2 & FUT'
 TITLE_NYCO = 'NYCO, NSPEC & EXP (OHA80113)'
 
+# Compared values, and their value on a side holding nothing under a key
+COMPARE_VALUE_COLS = ['q']
+COMPARE_FILL_VALUES = [0]
+
+# only compare with the position_recon hash join instead of tz_clearing.tz_wb_compare (one call
+# per account split) if told to, until comparecheck has shown both find the same breaks
+HASH_COMPARE = 'hashcompare' in sys.argv
+
+# Compare check: both comparisons on the latest local files, printing whether they agree, no
+# download and no email
+COMPARE_CHECK = 'comparecheck' in sys.argv
+
+# Backfill: reconciles every day of a date range, no download and no email
+# Ex: email_wedbush_position_check backfill 20260901 20260930
+BACKFILL_DT_FMT = '%Y%m%d'
+
+# When the morning run goes, for the posView of a wedPos the run did not download itself
+BACKFILL_RUN_TIME = datetime.time(9)
+
+############### FTP SETTINGS #######################################################################
+
+# Wedbush FTP login for the pooled download, read from the WEDBUSH_FTP_* environment variables
+# only.  Without WEDBUSH_FTP_HOST set the pooled download is off and the files come through
+# tz_clearing one after another, which the run prints when it happens.
+WB_FTP_HOST = os.environ.get('WEDBUSH_FTP_HOST')
+WB_FTP_USER = os.environ.get('WEDBUSH_FTP_USER')
+WB_FTP_PASSWORD = os.environ.get('WEDBUSH_FTP_PASSWORD')
+WB_FTP_PORT = int(os.environ.get('WEDBUSH_FTP_PORT', 21))
+
+FTP_CONNECTIONS = 3
+FTP_RETRIES = 3
+FTP_BACKOFF_SECONDS = 2
+FTP_TIMEOUT_SECONDS = 60
+
+# only download serially through tz_clearing if told to
+POOLED_FTP = 'serialftp' not in sys.argv
+
 ############### EMAIL SETTINGS #####################################################################
 
 EMAIL_SENDER = 'reports@tenzancapital.com'
@@ -50,12 +95,169 @@ TZ_FILE_TEMPLATE = os.path.join(TEN_DB_DIR, 'posView', '*.CSV')
 
 TZ_RAW_CSV_DIR_TEMPLATE = os.path.join(TEN_DB_DIR, 'tenTables', '*')
 
+BACKFILL_REPORT_DIR = os.path.join(TEN_POS_DIR, 'recon_backfill')
+BACKFILL_BREAKS_FILE_NAME = '%s_breaks_%s_%s.csv'
+BACKFILL_COUNTS_FILE_NAME = '%s_break_counts_%s_%s.csv'
+
+# Parsed position files, kept locally (not in Dropbox) under their path and modified time
+POS_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.tz_script_cache', 'positions')
+
+# posView is read this many rows at a time, keeping only firm accounts from each
+POS_READ_CHUNK_ROWS = 100000
+
+# Account columns read as categoricals
+TZ_ACCOUNT_COLS = ['a_type', 'a_abr']
+WB_ACCOUNT_COLS = ['PRR']
+
+TZ_FIRM_TYPES = ['frm']
+TZ_NEW_ACCOUNTS = ['NEW', 'NEWS', 'EXP2', 'FUT']
+
+TZ_NYCO_ACCOUNTS = ['NYCO', 'NSPEC', 'EXP']
+
+WB_FIRM_PRRS = ['ARBCH', 'OHA01']
+WB_NEW_ACCOUNTS = [70, 80110]
+WB_NYCO_PRRS = ['OHA01']
+WB_NYCO_ACCOUNTS = [80113]
+
+# Account splits on each side, {split: {column: allowed values}}
+TZ_SPLITS = {'NEW': {'a_abr': TZ_NEW_ACCOUNTS},
+             'NYCO': {'a_abr': TZ_NYCO_ACCOUNTS}}
+
+WB_SPLITS = {'NEW': {'PACCT': WB_NEW_ACCOUNTS},
+             'NYCO': {'PRR': WB_NYCO_PRRS, 'PACCT': WB_NYCO_ACCOUNTS}}
+
+# Tables of the comparison email, the splits each one compares (None for the whole firm)
+COMPARE_GROUPS = {'Overall %s' % REP_DESC: None,
+                  TITLE_NEW: ['NEW'],
+                  TITLE_NYCO: ['NYCO']}
+
 ######################## FTP DOWNLOAD ##############################################################
 
 
-def perform_ftp_download():
+class FTPConnectionPool(object):
+
+    # Logged in connections handed out to one download at a time and put back for the next
+
+    def __init__(self, host, user, password, port=21, timeout=FTP_TIMEOUT_SECONDS):
+
+        self.login_args = (host, user, password, port, timeout)
+        self.idle = queue.Queue()
+
+    def get(self):
+
+        try:
+            return self.idle.get_nowait()
+
+        except queue.Empty:
+
+            host, user, password, port, timeout = self.login_args
+
+            ftp = ftplib.FTP(timeout=timeout)
+            ftp.connect(host, port)
+            ftp.login(user or '', password or '')
+            ftp.voidcmd('TYPE I')  # SIZE is only reliable in binary mode
+
+            return ftp
+
+    def put(self, ftp):
+        self.idle.put(ftp)
+
+    def discard(self, ftp):
+
+        try:
+            ftp.close()
+
+        except ftplib.all_errors:
+            pass
+
+    def close(self):
+
+        while not self.idle.empty():
+            ftp = self.idle.get_nowait()
+
+            try:
+                ftp.quit()
+
+            except ftplib.all_errors:
+                ftp.close()
+
+
+def ftp_download_file(pool, ftp_fn, local_fn, retries=FTP_RETRIES,
+                      backoff_seconds=FTP_BACKOFF_SECONDS):
+
+    # Downloads one file over a pooled connection, skipping it if the local copy already has the
+    # remote size.  Failed attempts drop their connection and retry after a doubling backoff.
+    # Returns (status, seconds, bytes).
+
+    ftp_fn = ftp_fn.replace('\\', '/')
+    started = time.time()
+
+    for attempt in range(retries + 1):
+
+        ftp = None
+
+        try:
+            ftp = pool.get()
+            remote_size = ftp.size(ftp_fn)
+
+            if os.path.isfile(local_fn) and os.path.getsize(local_fn) == remote_size:
+                pool.put(ftp)
+                return 'skipped', time.time() - started, remote_size
+
+            tz_files.ensure_dir_exists(os.path.dirname(local_fn))
+
+            with open(local_fn + '.part', 'wb') as f:
+                ftp.retrbinary('RETR ' + ftp_fn, f.write)
 
-    timeDay = datetime.datetime.now() - datetime.timedelta(days=1)
+            os.replace(local_fn + '.part', local_fn)
+            pool.put(ftp)
+
+            return 'downloaded', time.time() - started, os.path.getsize(local_fn)
+
+        except (ftplib.all_errors + (OSError,)) as e:
+
+            if ftp is not None:
+                pool.discard(ftp)
+
+            # missing on the server, no point retrying
+            if isinstance(e, ftplib.error_perm) or attempt == retries:
+                print('FAILURE: %s after %d attempts: %s' % (ftp_fn, attempt + 1, e))
+                return 'failed', time.time() - started, 0
+
+            time.sleep(backoff_seconds * 2 ** attempt)
+
+
+def ftp_download_files(files_ftp_to_local, host, user, password, port=21,
+                       n_connections=FTP_CONNECTIONS, retries=FTP_RETRIES,
+                       backoff_seconds=FTP_BACKOFF_SECONDS):
+
+    # Downloads the files concurrently over up to n_connections reused connections, printing each
+    # file's time.  Returns {ftp file name: (status, seconds, bytes)}.
+
+    pool = FTPConnectionPool(host, user, password, port)
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_connections) as executor:
+            futures = {ftp_fn: executor.submit(ftp_download_file, pool, ftp_fn, local_fn,
+                                               retries, backoff_seconds)
+                       for ftp_fn, local_fn in files_ftp_to_local.items()}
+
+        results = {ftp_fn: future.result() for ftp_fn, future in futures.items()}
+
+    finally:
+        pool.close()
+
+    for ftp_fn, (status, seconds, n_bytes) in results.items():
+        print('%-10s %6.2fs %10d bytes  %s' % (status, seconds, n_bytes, ftp_fn))
+
+    return results
+
+
+def perform_ftp_download(pooled=True, trade_date=None):
+
+    # Files of trade_date, yesterday by default.  Returns the local position file, raising IOError
+    # if it could not be downloaded so no comparison goes out against an older one.
+    timeDay = trade_date or datetime.datetime.now() - datetime.timedelta(days=1)
     tmDay = timeDay.strftime("%Y%m%d")
 
     # Wedbush Position
@@ -76,7 +278,20 @@ def perform_ftp_download():
                           wb_mny_ftp_fn: wb_mny_fn}
 
     # Performing the download
-    tz_clearing.wedbush_ftp_download(files_ftp_to_local)
+    if pooled and WB_FTP_HOST:
+        ftp_download_files(files_ftp_to_local, WB_FTP_HOST, WB_FTP_USER, WB_FTP_PASSWORD,
+                           WB_FTP_PORT)
+    else:
+        if pooled:
+            print('WEDBUSH_FTP_HOST not set, downloading serially through tz_clearing')
+
+        tz_clearing.wedbush_ftp_download(files_ftp_to_local)
+
+    # a failed download never replaces the local file, so it is only there if the day's came in
+    if not os.path.isfile(wb_pos_fn):
+        raise IOError('Wedbush position file %s was not downloaded' % wb_pos_ftp_fn)
+
+    return wb_pos_fn
 
 ######################## FUNCTIONS: EMAIL  #########################################################
 
@@ -109,7 +324,9 @@ def send_statement_email(email_recipients, wb_stm_fn):
 #####################################################################################
 
 
-def send_comparison_email(rec_addresses, final_FIRM, final_NEW, tz_pos_fn, wb_pos_fn):
+def send_comparison_email(rec_addresses, final_dfs, tz_pos_fn, wb_pos_fn, break_counts=None):
+
+    # final_dfs: {table title: comparison df}, the first being the whole firm
 
     # Details included in email
 
@@ -133,12 +350,17 @@ def send_comparison_email(rec_addresses, final_FIRM, final_NEW, tz_pos_fn, wb_po
 
     email_subject = '%s %s: %s' % (CLEARING_SOURCE, REP_DESC, wb_pos_tm.strftime(SUB_DT_FMT))
 
+    final_FIRM = list(final_dfs.values())[0]
+
     email_html = tz_gmail.html_tag('ERRORS: %d' % len(final_FIRM), 'h2') + \
         tz_gmail.html_tag('<br>'.join(tz_detail_list), 'p') + \
-        tz_gmail.html_tag('<br>'.join(wb_detail_list), 'p') + \
-        tz_gmail.html_table('Overall %s' % REP_DESC, final_FIRM) + \
-        tz_gmail.html_table(TITLE_NEW, final_NEW)# + \
-        #tz_gmail.html_table(TITLE_NYCO, final_NYCO)
+        tz_gmail.html_tag('<br>'.join(wb_detail_list), 'p')
+
+    if break_counts is not None:
+        email_html += tz_gmail.html_table('Breaks by account', break_counts.reset_index())
+
+    for title, final_df in final_dfs.items():
+        email_html += tz_gmail.html_table(title, final_df)
 
     tz_gmail.send_mail(EMAIL_SENDER,
                        send_to=rec_addresses,
@@ -151,49 +373,215 @@ def send_comparison_email(rec_addresses, final_FIRM, final_NEW, tz_pos_fn, wb_po
 #####################################################################################
 
 
-def extract_tz_dfs(tz_pos_fn):
+def cached_parse(file_path, selection, parse):
+
+    # parse() of file_path, cached under the file's path, modified time and the selection (what
+    # was read and kept) so unchanged files are not parsed again
+
+    path_hash = hashlib.md5(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:12]
+    selection_hash = hashlib.md5(repr(selection).encode('utf-8')).hexdigest()[:12]
+
+    cache_prefix = os.path.join(POS_CACHE_DIR, '%s_%s_' % (path_hash, selection_hash))
+    cache_path = cache_prefix + '%d.pkl' % os.stat(file_path).st_mtime_ns
+
+    if os.path.isfile(cache_path):
+        return pd.read_pickle(cache_path)
+
+    parsed_df = parse()
+
+    tz_files.ensure_dir_exists(POS_CACHE_DIR)
+
+    # the same selection of an older version of the file is stale
+    for stale_path in glob.glob(cache_prefix + '*.pkl'):
+        os.remove(stale_path)
+
+    parsed_df.to_pickle(cache_path + '.tmp')
+    os.replace(cache_path + '.tmp', cache_path)
+
+    return parsed_df
+
+
+def as_categories(df, cols):
+
+    # Account columns as categoricals, the same categories whichever chunk a row came from
+    for col in cols:
+        df[col] = df[col].astype('category')
+
+    return df
+
+
+def without_categories(df):
+
+    # Categorical columns back to their plain dtype, tz_clearing groups and merges on them
+    for col in df.columns[df.dtypes == 'category']:
+        df[col] = df[col].astype(df[col].cat.categories.dtype)
+
+    return df
+
+
+def read_tz_positions(tz_pos_fn, columns, a_types=TZ_FIRM_TYPES):
+
+    # posView rows of the given account types, projected onto columns (in file order).  Only
+    # those columns are parsed, accounts as categoricals, and the rows are filtered a chunk at a
+    # time so the whole file never sits in memory.  Every other column is read as text, so no
+    # chunk infers a type of its own, and typed once over the whole file the way the comparison
+    # keys are (numbers if every value reads as one).
+
+    read_cols = set(columns) | set(TZ_ACCOUNT_COLS)
+
+    def parse():
 
-    # Read posView file into a df
-    tz_pos_df = pd.read_csv(tz_pos_fn)
+        chunks = pd.read_csv(tz_pos_fn, usecols=lambda col: col in read_cols,
+                             dtype={col: 'category' if col in TZ_ACCOUNT_COLS else str
+                                    for col in read_cols},
+                             chunksize=POS_READ_CHUNK_ROWS)
 
-    # We want only firm accounts, no test accounts from Happ
-    tz_pos_FIRM = tz_pos_df[tz_pos_df['a_type'].isin(['frm'])]
+        tz_pos_df = pd.concat([chunk[chunk['a_type'].isin(a_types)] for chunk in chunks])
+        tz_pos_df = as_categories(tz_pos_df, TZ_ACCOUNT_COLS)
 
-    # Get a subset of columns from Tenzan df
+        for col in read_cols.difference(TZ_ACCOUNT_COLS).intersection(tz_pos_df.columns):
+            tz_pos_df[col] = position_recon.normalized_keys(tz_pos_df[col].values)
+
+        return tz_pos_df[[col for col in tz_pos_df.columns if col in columns]]
+
+    return cached_parse(tz_pos_fn, ('posView', sorted(read_cols), list(a_types), 'typed'),
+                        parse)
+
+
+def read_wb_positions(wb_pos_fn, prrs=WB_FIRM_PRRS):
+
+    # Standardized Wedbush positions of the given PRRs, PRR as a categorical
+
+    def parse():
+
+        wb_pos_df = tz_clearing.stndrdize_wedPos2tenDb(wb_pos_fn)
+        wb_pos_df = wb_pos_df[wb_pos_df['PRR'].isin(prrs)]
+
+        return as_categories(wb_pos_df.copy(), WB_ACCOUNT_COLS)
+
+    return cached_parse(wb_pos_fn, ('wedPos', list(prrs)), parse)
+
+
+def extract_tz_dfs(tz_pos_fn):
+
+    # Read posView file into a df: only firm accounts (no test accounts from Happ), and only the
+    # columns compared against Wedbush
     tz_pos_FIRM_cols = list(tz_clearing.cols2use(CLEARING_SOURCE).keys())  # frm
-    tz_pos_FIRM = tz_pos_FIRM[tz_pos_FIRM.columns[tz_pos_FIRM.columns.isin(tz_pos_FIRM_cols)]]
+    tz_pos_FIRM = without_categories(read_tz_positions(tz_pos_fn, tz_pos_FIRM_cols))
 
     # Splitting up the accounts in Tenzan df
-    tz_pos_NEW = tz_pos_FIRM[tz_pos_FIRM['a_abr'].isin(['NEW', 'NEWS', 'EXP2', 'FUT'])]
-    #tz_pos_NYCO = tz_pos_FIRM[tz_pos_FIRM['a_abr'].isin(['NYCO', 'NSPEC', 'EXP'])]
+    tz_pos_NEW = tz_pos_FIRM[tz_pos_FIRM['a_abr'].isin(TZ_NEW_ACCOUNTS)]
+    tz_pos_NYCO = tz_pos_FIRM[tz_pos_FIRM['a_abr'].isin(TZ_NYCO_ACCOUNTS)]
 
-    return tz_pos_FIRM, tz_pos_NEW #, tz_pos_NYCO
+    return tz_pos_FIRM, tz_pos_NEW, tz_pos_NYCO
 
 
 def filter_wb_position(wb_pos_fn):
 
-    # Standardize Wedbush pos
-    wb_pos_all_df = tz_clearing.stndrdize_wedPos2tenDb(wb_pos_fn)
-
-    # Filter out the group account (9OH)
-    wb_pos_FIRM = wb_pos_all_df[wb_pos_all_df['PRR'].isin(['ARBCH', 'OHA01'])]
+    # Standardize Wedbush pos, filtering out the group account (9OH)
+    wb_pos_FIRM = without_categories(read_wb_positions(wb_pos_fn))
 
     # Splitting up the accounts in Wedbush df
     # compare by account: ARB and OHA80110 (split account), and OHA80113
-    wb_pos_NEW = wb_pos_FIRM[wb_pos_FIRM['PACCT'].isin([70, 80110])]
-    #wb_pos_NYCO_tmp = wb_pos_FIRM[wb_pos_FIRM['PRR'].isin(['OHA01'])]
-    #wb_pos_NYCO = wb_pos_NYCO_tmp[wb_pos_NYCO_tmp['PACCT'].isin([80113])]
+    wb_pos_NEW = wb_pos_FIRM[wb_pos_FIRM['PACCT'].isin(WB_NEW_ACCOUNTS)]
+    wb_pos_NYCO_tmp = wb_pos_FIRM[wb_pos_FIRM['PRR'].isin(WB_NYCO_PRRS)]
+    wb_pos_NYCO = wb_pos_NYCO_tmp[wb_pos_NYCO_tmp['PACCT'].isin(WB_NYCO_ACCOUNTS)]
+
+    return wb_pos_FIRM, wb_pos_NEW, wb_pos_NYCO
+
+
+def compare_key_cols(tz_pos_FIRM, wb_pos_FIRM):
+
+    # The Wedbush positions with the compared columns under their Tenzan names, and the key
+    # columns (contract, strike, put/call...).  cols2use maps Tenzan names (keys) to Wedbush
+    # names (values); a key column missing from either side after renaming raises.
+
+    compare_cols = tz_clearing.cols2use(CLEARING_SOURCE)
+
+    # Wedbush columns under their Tenzan names where standardizing left them named otherwise
+    wb_pos_FIRM = wb_pos_FIRM.rename(columns={wb_col: tz_col
+                                              for tz_col, wb_col in compare_cols.items()
+                                              if tz_col not in wb_pos_FIRM.columns})
+
+    key_cols = [col for col in compare_cols if col not in COMPARE_VALUE_COLS + TZ_ACCOUNT_COLS]
+
+    missing = [(side, col) for side, pos_df in [('Tenzan', tz_pos_FIRM), ('Wedbush', wb_pos_FIRM)]
+               for col in key_cols if col not in pos_df.columns]
+
+    if missing:
+        raise KeyError('Compared columns missing from the positions: %s' %
+                       ', '.join('%s %s' % side_col for side_col in missing))
+
+    return wb_pos_FIRM, key_cols
+
+
+def compare_positions(tz_pos_FIRM, wb_pos_FIRM):
+
+    # Every account grouping of COMPARE_GROUPS from one hash join of the two firm positions,
+    # keyed on the compared columns within each account split.  Returns {table title:
+    # mismatched rows} and the break counts per table.
+
+    wb_pos_FIRM, key_cols = compare_key_cols(tz_pos_FIRM, wb_pos_FIRM)
+
+    return position_recon.reconcile(tz_pos_FIRM, wb_pos_FIRM, key_cols, COMPARE_VALUE_COLS,
+                                    COMPARE_FILL_VALUES, TZ_SPLITS, WB_SPLITS, COMPARE_GROUPS)
+
+
+def legacy_compare_positions(tz_pos_dfs, wb_pos_dfs):
+
+    # Each account split through tz_clearing.tz_wb_compare.  Returns {table title: comparison df}.
+
+    comparison_args = (COMPARE_VALUE_COLS, COMPARE_FILL_VALUES, CLEARING_SOURCE)
+
+    return {title: tz_clearing.tz_wb_compare(wb_pos_df, tz_pos_df, *comparison_args)
+            for title, tz_pos_df, wb_pos_df in zip(COMPARE_GROUPS, tz_pos_dfs, wb_pos_dfs)}
+
+
+def compare_check(tz_pos_fn, wb_pos_fn):
+
+    # Runs both comparisons on the same files and prints, per table, whether they break on the
+    # same keys.  Returns {table title: True if they agree}.
+
+    tz_pos_dfs = extract_tz_dfs(tz_pos_fn)
+    wb_pos_dfs = filter_wb_position(wb_pos_fn)
+
+    legacy_dfs = legacy_compare_positions(tz_pos_dfs, wb_pos_dfs)
+    hash_dfs, _ = compare_positions(tz_pos_dfs[0], wb_pos_dfs[0])
+
+    key_cols = compare_key_cols(tz_pos_dfs[0], wb_pos_dfs[0])[1]
+
+    agreement = {}
+
+    for title in COMPARE_GROUPS:
+
+        unchecked_cols = [col for col in key_cols if col not in legacy_dfs[title].columns]
+
+        legacy_keys = position_recon.break_keys(legacy_dfs[title],
+                                                [col for col in key_cols
+                                                 if col not in unchecked_cols])
+        hash_keys = position_recon.break_keys(hash_dfs[title],
+                                              [col for col in key_cols
+                                               if col not in unchecked_cols])
+
+        agreement[title] = legacy_keys == hash_keys and not unchecked_cols
+
+        print('%s: %s: %d breaks from tz_wb_compare, %d from the hash join, %d only in '
+              'tz_wb_compare, %d only in the hash join' %
+              ({True: 'SUCCESS', False: 'FAILURE'}[agreement[title]], title, len(legacy_keys),
+               len(hash_keys), len(legacy_keys - hash_keys), len(hash_keys - legacy_keys)))
+
+        if unchecked_cols:
+            print('    tz_wb_compare output has no %s columns to compare on' % unchecked_cols)
 
-    return wb_pos_FIRM, wb_pos_NEW #, wb_pos_NYCO
+    return agreement
 
 
-def run():
+def run(pooled_ftp=True, hash_compare=False):
 
-    # Downloading files form Wedbush FTP
-    perform_ftp_download()
+    # Downloading files form Wedbush FTP, stopping before any email if the position file failed
+    wb_pos_fn = perform_ftp_download(pooled_ftp)
 
-    # Determining latest statement and wedPos files names
-    wb_pos_fn = tz_files.latest_file_from_template(WB_POS_PATH_TEMPLATE % '*')
+    # Determining latest statement file name
     wb_stm_fn = tz_files.latest_file_from_template(WB_STM_PATH_TEMPLATE % '*')
 
     # emailing statement (internal to TZ)
@@ -203,19 +591,147 @@ def run():
     tz_pos_fn = tz_files.latest_file_from_template(TZ_FILE_TEMPLATE)
 
     # Pulling relevant info from TZ and WB
-    tz_pos_FIRM, tz_pos_NEW = extract_tz_dfs(tz_pos_fn)
-    wb_pos_FIRM, wb_pos_NEW = filter_wb_position(wb_pos_fn)
+    tz_pos_dfs = extract_tz_dfs(tz_pos_fn)
+    wb_pos_dfs = filter_wb_position(wb_pos_fn)
 
     # Performing the Comparison
-    comparison_args = (['q'], [0], CLEARING_SOURCE)
+    if hash_compare:
+        final_dfs, break_counts = compare_positions(tz_pos_dfs[0], wb_pos_dfs[0])
 
-    final_pos_FIRM = tz_clearing.tz_wb_compare(wb_pos_FIRM, tz_pos_FIRM, *comparison_args)
-    final_pos_NEW = tz_clearing.tz_wb_compare(wb_pos_NEW, tz_pos_NEW, *comparison_args)
-    #final_pos_NYCO = tz_clearing.tz_wb_compare(wb_pos_NYCO, tz_pos_NYCO, *comparison_args)
+    else:
+        final_dfs = legacy_compare_positions(tz_pos_dfs, wb_pos_dfs)
+        break_counts = None
 
     # emailing comparison (to both TZ and WB)
-    send_comparison_email(EMAIL_RECIPIENTS_SUMMARY, final_pos_FIRM,
-                          final_pos_NEW, tz_pos_fn, wb_pos_fn)
+    send_comparison_email(EMAIL_RECIPIENTS_SUMMARY, final_dfs, tz_pos_fn, wb_pos_fn, break_counts)
+
+######################## BACKFILL ##################################################################
+
+
+def tz_pos_file_for_day(trade_date, wb_pos_fn):
+
+    # The posView run() would have compared with trade_date's wedPos.  run() goes the morning
+    # after the trade date, downloads the wedPos and takes the latest posView at that moment, so
+    # this is the last posView modified by the time the wedPos was downloaded if that was the
+    # day after, otherwise by BACKFILL_RUN_TIME that day, and not before the trade date.  None if
+    # there is none.
+
+    run_date = trade_date.date() + datetime.timedelta(days=1)
+    downloaded = datetime.datetime.fromtimestamp(os.path.getmtime(wb_pos_fn))
+
+    if downloaded.date() == run_date:
+        cutoff = downloaded
+    else:
+        cutoff = datetime.datetime.combine(run_date, BACKFILL_RUN_TIME)
+
+    day_fns = [fn for fn in glob.glob(TZ_FILE_TEMPLATE)
+               if trade_date.date() <= datetime.date.fromtimestamp(os.path.getmtime(fn))
+               and datetime.datetime.fromtimestamp(os.path.getmtime(fn)) <= cutoff]
+
+    return max(day_fns, key=os.path.getmtime) if day_fns else None
+
+
+def backfill_day_files(start_date, end_date):
+
+    # (trade date, wedPos file, posView file) of each day in the range with a wedPos file
+
+    day_files = []
+
+    for trade_date in pd.date_range(start_date, end_date).to_pydatetime():
+
+        wb_pos_fn = WB_POS_PATH_TEMPLATE % trade_date.strftime('%Y%m%d')
+
+        if os.path.isfile(wb_pos_fn):
+            day_files.append((trade_date, wb_pos_fn, tz_pos_file_for_day(trade_date, wb_pos_fn)))
+
+    return day_files
+
+
+def reconcile_day(trade_date, wb_pos_fn, tz_pos_fn, hash_compare=False):
+
+    # One day's comparison for the backfill, runs in a worker process, through the same engine
+    # as run().  Returns the day's breaks and break counts as flat dfs with the date and group on
+    # every row.
+
+    tz_pos_dfs = extract_tz_dfs(tz_pos_fn)
+    wb_pos_dfs = filter_wb_position(wb_pos_fn)
+
+    if hash_compare:
+        final_dfs, break_counts = compare_positions(tz_pos_dfs[0], wb_pos_dfs[0])
+
+    else:
+        final_dfs = legacy_compare_positions(tz_pos_dfs, wb_pos_dfs)
+        break_counts = pd.DataFrame({'breaks': [len(final_df) for final_df in final_dfs.values()]},
+                                    index=pd.Index(list(final_dfs), name='group'))
+
+    day_cols = {'date': trade_date.strftime('%Y-%m-%d'),
+                'wb_pos_file': os.path.basename(wb_pos_fn),
+                'tz_pos_file': os.path.basename(tz_pos_fn)}
+
+    breaks = pd.concat([final_df.assign(group=group) for group, final_df in final_dfs.items()],
+                       ignore_index=True)
+
+    return breaks.assign(**day_cols), break_counts.reset_index().assign(**day_cols)
+
+
+def backfill(start_date, end_date, max_workers=None, hash_compare=False):
+
+    # Reconciles every day from start_date to end_date across a process pool and writes one
+    # breaks report and one break counts report for the range.  Sends no email.
+
+    day_files = backfill_day_files(start_date, end_date)
+
+    for trade_date, wb_pos_fn, tz_pos_fn in day_files:
+        if tz_pos_fn is None:
+            print('FAILURE: no posView for %s, skipped' % trade_date.strftime('%Y-%m-%d'))
+
+    day_files = [files for files in day_files if files[2] is not None]
+
+    if not day_files:
+        print('No days to reconcile from %s to %s' % (start_date, end_date))
+        return None
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        day_results = list(executor.map(reconcile_day, *zip(*day_files),
+                                        [hash_compare] * len(day_files)))
+
+    # date and group first
+    front_cols = ['date', 'group']
+
+    breaks = pd.concat([day_breaks for day_breaks, _ in day_results], ignore_index=True)
+    breaks = breaks[front_cols + [col for col in breaks.columns if col not in front_cols]]
+
+    break_counts = pd.concat([day_counts for _, day_counts in day_results], ignore_index=True)
+    break_counts = break_counts[front_cols + [col for col in break_counts.columns
+                                              if col not in front_cols]]
+
+    tz_files.ensure_dir_exists(BACKFILL_REPORT_DIR)
+
+    range_args = (CLEARING_SOURCE, start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'))
+
+    breaks_fn = os.path.join(BACKFILL_REPORT_DIR, BACKFILL_BREAKS_FILE_NAME % range_args)
+    counts_fn = os.path.join(BACKFILL_REPORT_DIR, BACKFILL_COUNTS_FILE_NAME % range_args)
+
+    breaks.to_csv(breaks_fn, index=False)
+    break_counts.to_csv(counts_fn, index=False)
+
+    print('%d days reconciled, %d breaks: %s' % (len(day_results), len(breaks), breaks_fn))
+    print('Break counts: %s' % counts_fn)
+
+    return breaks_fn, counts_fn
+
 
 if __name__ == '__main__':
-    run()
+
+    if 'backfill' in sys.argv:
+        backfill_dates = sys.argv[sys.argv.index('backfill') + 1:][:2]
+
+        backfill(*[datetime.datetime.strptime(date_str, BACKFILL_DT_FMT)
+                   for date_str in backfill_dates], hash_compare=HASH_COMPARE)
+
+    elif COMPARE_CHECK:
+        compare_check(tz_files.latest_file_from_template(TZ_FILE_TEMPLATE),
+                      tz_files.latest_file_from_template(WB_POS_PATH_TEMPLATE % '*'))
+
+    else:
+        run(POOLED_FTP, HASH_COMPARE)
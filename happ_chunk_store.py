@@ -0,0 +1,233 @@
+# Content-addressed store of Happ backup bins: files cut into content-defined chunks, each chunk kept
+# once however many backups share it, one manifest per backup to rebuild its bins from
+
+# Standards
+import sys
+import os
+import json
+import glob
+import hashlib
+import threading
+import zlib
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+################## CONSTANTS #######################################################################
+
+CHUNKS_DIR_NAME = 'chunks'
+MANIFESTS_DIR_NAME = 'manifests'
+
+# Chunk cuts come from a gear hash of the last GEAR_WINDOW bytes, so an edit only moves the cuts
+# around it.  A cut falls where the top CUT_MASK_BITS bits of the hash are 0 (256 KiB on average),
+# kept between CHUNK_MIN_BYTES and CHUNK_MAX_BYTES apart.
+GEAR_WINDOW = 32
+CUT_MASK_BITS = 18
+CHUNK_MIN_BYTES = 64 << 10
+CHUNK_MAX_BYTES = 2 << 20
+
+# Fixed for good, cuts (and so chunk ids) depend on it
+GEAR = np.array([int.from_bytes(hashlib.sha256(bytes([b])).digest()[:4], 'little')
+                 for b in range(256)], dtype=np.uint32)
+
+# bytes hashed per pass while looking for cuts
+SCAN_BYTES = 8 << 20
+
+STORE_WORKERS = os.cpu_count() or 4
+
+################## FUNCTIONS: CHUNKING #############################################################
+
+
+def cut_candidates(data):
+
+    # Offsets in data (uint8 array) where the gear hash allows a chunk to end
+
+    candidates = []
+
+    for start in range(0, len(data), SCAN_BYTES):
+
+        # the window reaches back GEAR_WINDOW - 1 bytes, zeros before the start of the file
+        lo = max(0, start - (GEAR_WINDOW - 1))
+        gears = np.concatenate([np.zeros(GEAR_WINDOW - 1 - (start - lo), dtype=np.uint32),
+                                GEAR[data[lo:start + SCAN_BYTES]]])
+
+        n_bytes = len(gears) - (GEAR_WINDOW - 1)
+        hashes = np.zeros(n_bytes, dtype=np.uint32)
+
+        for k in range(GEAR_WINDOW):
+            hashes += gears[GEAR_WINDOW - 1 - k:GEAR_WINDOW - 1 - k + n_bytes] << np.uint32(k)
+
+        ends = np.flatnonzero((hashes >> np.uint32(32 - CUT_MASK_BITS)) == 0) + start + 1
+        candidates.append(ends)
+
+    return np.concatenate(candidates) if candidates else np.empty(0, dtype=np.int64)
+
+
+def chunk_bounds(data):
+
+    # (start, end) of each chunk of data
+
+    n_bytes, last, cuts = len(data), 0, []
+
+    for end in cut_candidates(data).tolist() + [n_bytes]:
+
+        while end - last > CHUNK_MAX_BYTES:
+            last += CHUNK_MAX_BYTES
+            cuts.append(last)
+
+        if end - last >= CHUNK_MIN_BYTES or (end == n_bytes and end > last):
+            cuts.append(end)
+            last = end
+
+    return list(zip([0] + cuts[:-1], cuts))
+
+################## FUNCTIONS: STORE ################################################################
+
+
+def chunk_path(store_dir, chunk_id):
+    return os.path.join(store_dir, CHUNKS_DIR_NAME, chunk_id[:2], chunk_id + '.zz')
+
+
+def put_chunk(store_dir, chunk):
+
+    # Stores chunk under its sha256 unless already there, returning the id and whether it was new
+
+    chunk_id = hashlib.sha256(chunk).hexdigest()
+    path = chunk_path(store_dir, chunk_id)
+
+    if os.path.isfile(path):
+        return chunk_id, False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = '%s.%d.tmp' % (path, threading.get_ident())
+
+    with open(tmp_path, 'wb') as f:
+        f.write(zlib.compress(chunk))
+
+    os.replace(tmp_path, path)
+
+    return chunk_id, True
+
+
+def get_chunk(store_dir, chunk_id):
+
+    with open(chunk_path(store_dir, chunk_id), 'rb') as f:
+        chunk = zlib.decompress(f.read())
+
+    if hashlib.sha256(chunk).hexdigest() != chunk_id:
+        raise ValueError('Chunk %s is corrupt' % chunk_id)
+
+    return chunk
+
+
+def store_bin_file(store_dir, bin_path):
+
+    # Chunks one bin file into the store, returning its manifest entry and bytes newly stored
+
+    n_bytes = os.path.getsize(bin_path)
+    data = (np.memmap(bin_path, dtype=np.uint8, mode='r') if n_bytes
+            else np.empty(0, dtype=np.uint8))
+
+    sha256 = hashlib.sha256()
+    chunk_ids, new_bytes = [], 0
+
+    for start, end in chunk_bounds(data):
+
+        chunk = data[start:end].tobytes()
+        sha256.update(chunk)
+
+        chunk_id, is_new = put_chunk(store_dir, chunk)
+        chunk_ids.append(chunk_id)
+
+        if is_new:
+            new_bytes += len(chunk)
+
+    del data
+
+    entry = {'size': n_bytes, 'sha256': sha256.hexdigest(), 'chunks': chunk_ids}
+
+    return entry, new_bytes
+
+
+def store_snapshot(store_dir, snapshot_name, bin_paths, max_workers=STORE_WORKERS):
+
+    # Chunks the bin files into the store and writes the snapshot's manifest.  Returns the bytes
+    # of new chunks, the rest were already held from earlier snapshots.
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        stored = list(executor.map(lambda path: store_bin_file(store_dir, path), bin_paths))
+
+    manifest = {os.path.basename(path): entry for path, (entry, _) in zip(bin_paths, stored)}
+
+    manifest_path = os.path.join(store_dir, MANIFESTS_DIR_NAME, snapshot_name + '.json')
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+
+    # manifest last, so a snapshot is only listed once all its chunks are in
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return sum(new_bytes for _, new_bytes in stored)
+
+
+def snapshots(store_dir):
+
+    # Sorted names of the snapshots in the store
+
+    manifest_paths = glob.glob(os.path.join(store_dir, MANIFESTS_DIR_NAME, '*.json'))
+
+    return sorted(os.path.splitext(os.path.basename(path))[0] for path in manifest_paths)
+
+
+def restore_snapshot(store_dir, snapshot_name, output_dir):
+
+    # Rebuilds the snapshot's bin files in output_dir, checking each against its sha256
+
+    with open(os.path.join(store_dir, MANIFESTS_DIR_NAME, snapshot_name + '.json'), 'r') as f:
+        manifest = json.load(f)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    restored_paths = []
+
+    for bin_name, entry in sorted(manifest.items()):
+
+        bin_path = os.path.join(output_dir, bin_name)
+        sha256 = hashlib.sha256()
+
+        with open(bin_path + '.tmp', 'wb') as f:
+            for chunk_id in entry['chunks']:
+
+                chunk = get_chunk(store_dir, chunk_id)
+                sha256.update(chunk)
+
+                f.write(chunk)
+
+        if sha256.hexdigest() != entry['sha256']:
+            raise ValueError('Restored %s does not match its manifest' % bin_name)
+
+        os.replace(bin_path + '.tmp', bin_path)
+        restored_paths.append(bin_path)
+
+    return restored_paths
+
+
+####### SCRIPT #####################################################################################
+
+
+if __name__ == '__main__':
+
+    # python -m tz_script.happ_chunk_store <store_dir> list
+    # python -m tz_script.happ_chunk_store <store_dir> restore <snapshot> <output_dir>
+    if sys.argv[2:3] == ['list'] and len(sys.argv) == 3:
+        print('\n'.join(snapshots(sys.argv[1])))
+
+    elif sys.argv[2:3] == ['restore'] and len(sys.argv) == 5:
+        restored_paths = restore_snapshot(sys.argv[1], sys.argv[3], sys.argv[4])
+        print('%d bin files restored to %s' % (len(restored_paths), sys.argv[4]))
+
+    else:
+        print('usage: happ_chunk_store <store_dir> list | restore <snapshot> <output_dir>')
@@ -4,10 +4,18 @@ import os
 import glob
 import datetime
 import time
+import hashlib
+import shutil
+import tempfile
+import zipfile
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
 
 # Locals
 from tz_interface import tz_dropbox, tz_files
 from tz_interface.tz_happ import tz_happ_auto, tz_happ_tables
+from tz_script import happ_chunk_store
 
 # CONSTANTS SET BY SYS ARG #########################################################################
 
@@ -17,6 +25,25 @@ if 'complete' in sys.argv:
 else:
     SCRIPT_ARGS = (False, 12, 45)
 
+# only sit out the whole allowance if told to, otherwise continue once the bin files are complete
+WAIT_FOR_FILES = 'fixedwait' not in sys.argv
+
+# bin files count as complete once their sizes and modified times hold still this long
+BACKUP_STABLE_SECONDS = 3
+BACKUP_POLL_SECONDS = 0.5
+
+# bin files are compressed on this many threads (zlib and hashlib let go of the GIL), streaming this
+# many bytes at a time through each
+ARCHIVE_WORKERS = os.cpu_count() or 4
+ARCHIVE_CHUNK_BYTES = 1 << 20
+
+# only keep new chunks of the bins in the chunk store, in place of a full zip, if told to
+INCREMENTAL = 'incremental' in sys.argv
+
+# incremental backups keep this many of the latest bin folders locally, older ones are restored
+# from the chunk store when needed
+LOCAL_BACKUPS_KEPT = 1
+
 # only send signal to processor if in production
 if 'p' in sys.argv:
 
@@ -51,46 +78,249 @@ def wait_for_backup(wait_time):
     print(prefix + str(0).zfill(digs))
 
 
+def bin_file_stats(backup_dir, since):
+
+    # {path: (size, modified time)} of the bin files written since the backup started
+
+    stats = {}
+
+    for bin_path in glob.glob(os.path.join(backup_dir, '*.bin')):
+
+        try:
+            stat = os.stat(bin_path)
+
+        except OSError:
+            continue
+
+        if stat.st_mtime >= since:
+            stats[bin_path] = (stat.st_size, stat.st_mtime_ns)
+
+    return stats
+
+
+def wait_for_backup_files(backup_dir, n_bins_expect, started, timeout,
+                          stable_seconds=BACKUP_STABLE_SECONDS, poll_seconds=BACKUP_POLL_SECONDS):
+
+    # Returns True as soon as n_bins_expect bin files written since started have held their sizes
+    # and modified times for stable_seconds, False if that has not happened within timeout
+
+    prefix = 'Waiting up to %d seconds for happ backup: ' % timeout
+
+    deadline = time.time() + timeout
+    prev_stats, stable_since = None, None
+
+    while True:
+
+        stats = bin_file_stats(backup_dir, started)
+
+        if stats != prev_stats:
+            prev_stats, stable_since = stats, time.time()
+
+        print(prefix + '%d of %d bin files' % (len(stats), n_bins_expect), end='\r')
+
+        if len(stats) >= n_bins_expect and time.time() - stable_since >= stable_seconds:
+            print(prefix + 'done in %d seconds' % (timeout - (deadline - time.time())))
+            return True
+
+        if time.time() >= deadline:
+            print(prefix + 'timed out with %d of %d bin files' % (len(stats), n_bins_expect))
+            return False
+
+        time.sleep(poll_seconds)
+
+
+def place_bin_files(bin_paths, backup_dir):
+
+    # Renames the bin files into backup_dir, no copy as it is in the folder Happ wrote them to
+
+    placed_paths = []
+
+    for bin_path in bin_paths:
+
+        placed_path = os.path.join(backup_dir, os.path.basename(bin_path))
+        os.replace(bin_path, placed_path)
+
+        placed_paths.append(placed_path)
+
+    return placed_paths
+
+
+def compress_bin_file(bin_path, member_path, chunk_bytes=ARCHIVE_CHUNK_BYTES):
+
+    # Streams bin_path through raw deflate into member_path, returning the zip entry for it and
+    # the sha256 of the original bytes
+
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    sha256 = hashlib.sha256()
+    crc, file_size = 0, 0
+
+    with open(bin_path, 'rb') as bin_file, open(member_path, 'wb') as member_file:
+
+        for chunk in iter(lambda: bin_file.read(chunk_bytes), b''):
+
+            sha256.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+
+            member_file.write(compressor.compress(chunk))
+
+        member_file.write(compressor.flush())
+
+    zinfo = zipfile.ZipInfo(os.path.basename(bin_path),
+                            time.localtime(os.path.getmtime(bin_path))[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = os.path.getsize(member_path)
+
+    return zinfo, sha256.hexdigest()
+
+
+def verify_archive_member(zip_path, member_name, expected_sha256, chunk_bytes=ARCHIVE_CHUNK_BYTES):
+
+    # Reads a member back out of the zip (zipfile checks its CRC) and compares sha256s
+
+    sha256 = hashlib.sha256()
+
+    with zipfile.ZipFile(zip_path) as zf, zf.open(member_name) as member:
+        for chunk in iter(lambda: member.read(chunk_bytes), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest() == expected_sha256
+
+
+def write_deflated_member(zf, zinfo, member_path):
+
+    # Appends member_path, already raw deflated with zinfo's CRC and sizes filled in, to zf as
+    # is.  zipfile has no public way to add compressed bytes, so this is the one place relying
+    # on its internals (fp, start_dir, filelist, NameToInfo, ZipInfo.FileHeader), checked by
+    # tests/test_make_happ_backup.py against Python's own zip reader.
+
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader())
+
+    with open(member_path, 'rb') as member_file:
+        shutil.copyfileobj(member_file, zf.fp, ARCHIVE_CHUNK_BYTES)
+
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = zf.fp.tell()
+
+
+def archive_bin_files(bin_paths, zip_path, max_workers=ARCHIVE_WORKERS):
+
+    # Compresses the bin files in parallel, each into its own deflate stream, then writes those
+    # streams as the members of zip_path and checks every member against the original's sha256.
+    # Memory stays at a chunk per worker whatever the size of the bins.  The streams are kept in a
+    # local temp dir, so only the zip itself is written next to zip_path (in Dropbox).
+
+    parts_dir = tempfile.mkdtemp(prefix='happ_zip_parts')
+
+    member_paths = [os.path.join(parts_dir, os.path.basename(path) + '.deflate')
+                    for path in bin_paths]
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            compressed = list(executor.map(compress_bin_file, bin_paths, member_paths))
+
+        with zipfile.ZipFile(zip_path + '.tmp', 'w') as zf:
+            for (zinfo, _), member_path in zip(compressed, member_paths):
+                write_deflated_member(zf, zinfo, member_path)
+
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+    os.replace(zip_path + '.tmp', zip_path)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        verified = list(executor.map(verify_archive_member, [zip_path] * len(compressed),
+                                     [zinfo.filename for zinfo, _ in compressed],
+                                     [sha256 for _, sha256 in compressed]))
+
+    return all(verified)
+
+
+def prune_local_backups(local_parent_dir, n_kept=LOCAL_BACKUPS_KEPT):
+
+    # Removes all but the latest n_kept backup folders, their names sort by time
+
+    backup_dirs = sorted(path for path in glob.glob(os.path.join(local_parent_dir, '*_happDb'))
+                         if os.path.isdir(path))
+
+    for backup_dir in backup_dirs[:max(0, len(backup_dirs) - n_kept)]:
+        shutil.rmtree(backup_dir, ignore_errors=True)
+
+
 # FILE PATH STUFF ##################################################################################
 
 DROPBOX_PATH = tz_dropbox.toStr()
 HAPP_PARENT_BACKUP_DIR = os.path.join(DROPBOX_PATH, 'tenDb_raw', DB_DUMP_DIR)
+HAPP_CHUNK_STORE_DIR = os.path.join(HAPP_PARENT_BACKUP_DIR, 'happ_chunks')
+
+# Incremental backups are written and kept outside Dropbox, only the chunk store is synced.  The
+# bins of any snapshot come back out of it with:
+#   python -m tz_script.happ_chunk_store <HAPP_CHUNK_STORE_DIR> restore <snapshot> <output_dir>
+HAPP_LOCAL_BACKUP_DIR = os.path.join(os.path.expanduser('~'), 'tz_data', 'happ_backups',
+                                     DB_DUMP_DIR)
 
 # SCRIPT ###########################################################################################
 
 
-def run(include_hist_in_dump, n_bins_expect, backup_time_allowance):
+def run(include_hist_in_dump, n_bins_expect, backup_time_allowance, wait_for_files=True,
+        incremental=False):
 
     print('Starting make_happ_backup')
 
+    # Incremental backups never put the bins in Dropbox, only their chunks
+    parent_backup_dir = HAPP_LOCAL_BACKUP_DIR if incremental else HAPP_PARENT_BACKUP_DIR
+    tz_files.ensure_dir_exists(parent_backup_dir)
+
     # The folder name, folder path, and zip where bin files will go
     happ_backup_dir_name = datetime.datetime.now().strftime('%Y_%m_%d_%H%M') + '_happDb'
-    happ_backup_dir = os.path.join(HAPP_PARENT_BACKUP_DIR, happ_backup_dir_name)
+    happ_backup_dir = os.path.join(parent_backup_dir, happ_backup_dir_name)
     happ_backup_zip = happ_backup_dir + '.zip'
 
-    # Running backup and waiting for it to finish
-    tz_happ_auto.happ_backup_database(HAPP_PARENT_BACKUP_DIR, include_hist_in_dump)
-    wait_for_backup(backup_time_allowance)
+    # Running backup and waiting for it to finish, at most the allowance when watching the files
+    backup_started = time.time()
+    tz_happ_auto.happ_backup_database(parent_backup_dir, include_hist_in_dump)
+
+    if wait_for_files:
+        wait_for_backup_files(parent_backup_dir, n_bins_expect, backup_started,
+                              backup_time_allowance)
+    else:
+        wait_for_backup(backup_time_allowance)
 
     # Gathering resulting .bin paths
-    backup_bin_paths = glob.glob(os.path.join(HAPP_PARENT_BACKUP_DIR, '*.bin'))
+    backup_bin_paths = glob.glob(os.path.join(parent_backup_dir, '*.bin'))
 
     # Checking number of bin files created are what we expect
     n_bins_actual = len(backup_bin_paths)
     status_msg = '%d of %d bin files created by happ backup.' % (n_bins_actual, n_bins_expect)
     print({True: 'SUCCESS: %s', False: 'FAILURE: %s'}[n_bins_actual == n_bins_expect] % status_msg)
 
-    # Zip the bin files
-    tz_files.make_zip(backup_bin_paths, happ_backup_zip)
-    print('Zip created: %s' % happ_backup_zip)
-
     # Making new folder
     tz_files.ensure_dir_exists(happ_backup_dir)
 
     # Moving .bin files into new folder
-    tz_files.move_files(backup_bin_paths, happ_backup_dir)
+    backup_bin_paths = place_bin_files(backup_bin_paths, happ_backup_dir)
     print('BINs put in: %s' % happ_backup_dir)
 
+    # Chunks of the bin files not already held go in the chunk store, with a manifest to restore
+    if incremental:
+        new_bytes = happ_chunk_store.store_snapshot(HAPP_CHUNK_STORE_DIR, happ_backup_dir_name,
+                                                    backup_bin_paths)
+        total_bytes = sum(os.path.getsize(path) for path in backup_bin_paths)
+        print('Snapshot %s stored: %d of %d bytes new' % (happ_backup_dir_name, new_bytes,
+                                                          total_bytes))
+
+        prune_local_backups(parent_backup_dir)
+
+    # Zip the bin files, checking the zip against them
+    else:
+        zip_verified = archive_bin_files(backup_bin_paths, happ_backup_zip)
+        print('Zip created: %s' % happ_backup_zip)
+        print({True: 'SUCCESS: %s', False: 'FAILURE: %s'}[zip_verified] % 'zip checksums verified.')
+
     # Sends signal that backup is complete
     if SEND_SIGNAL:
         tz_happ_tables.generate_file_signal()
@@ -100,4 +330,4 @@ def run(include_hist_in_dump, n_bins_expect, backup_time_allowance):
 
 
 if __name__ == '__main__':
-    run(*SCRIPT_ARGS)
+    run(*SCRIPT_ARGS, wait_for_files=WAIT_FOR_FILES, incremental=INCREMENTAL)
@@ -1,70 +1,436 @@
 # Standards
+import sys
 import os
+import glob
+import pickle
+import hashlib
 
+import numpy as np
 import pandas as pd
 # pd.set_option('max_rows', 500)
 
 from datetime import datetime as dt
+from statistics import NormalDist
+from collections import OrderedDict
 
 # Locals
-from tz_interface import tz_dropbox
+from tz_interface import tz_dropbox, tz_files
 from tz_interface.tz_happ import tz_happ_tables
 
 from tz_calculation import tz_bls
 
 DROPBOX_PATH = tz_dropbox.toStr()
 
-####### SCRIPT ##################################################################################
+####### CONSTANTS ##################################################################################
 
-def run():
+# Happ DB snapshots, one CSV per table.  Ex: tenTables/<snapshot>/month.csv
+TEN_DB_DIR = os.path.join(DROPBOX_PATH, 'tenDb_raw')
+SNAPSHOT_DIR_TEMPLATE = os.path.join(TEN_DB_DIR, 'tenTables', '*')
+SNAPSHOT_TABLE_FILE_NAME = '%s.csv'
 
-    # pulling the altest cleaned month table
-    m_df = tz_happ_tables.get_last_cleaned_db_dic()['month']
+# snapshot tables are read this many rows at a time, keeping only the selected rows of each
+SNAPSHOT_READ_CHUNK_ROWS = 100000
 
-    # filtering for eurodollars
-    m_df = m_df[m_df['u_abr'].str[0:2] == 'ED']
+# Tables read out of a snapshot, kept locally (not in Dropbox) under the snapshot and selection
+SNAPSHOT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.tz_script_cache', 'tables')
 
-    def calc_ed_strikes(df_row):
+# Only the month table columns used here, and only eurodollar rows
+MONTH_COLS = ['u_abr', 'm_abr', 'skew_price', 'slope_vatm', 'dexp']
+MONTH_PREFIXES = {'u_abr': 'ED'}
 
-        u_prc = df_row['skew_price']
-        m_vol = df_row['slope_vatm'] / 100
+# Delta staged for the squash, as a put and a call with the lots for each
+SQUASH_DELTA = 0.25
+LEG_QUANTITIES = [1000, -1000]
+LEG_PCS = ['P', 'C']
 
-        df_row['t_exp'] = (dt.strptime(df_row['dexp'], '%Y-%m-%d') - dt.today()).days / 365.25
-        m_exp = df_row['t_exp']
+# Grid mode: every delta across every vol shock (in slope_vatm vol points)
+GRID_DELTAS = [0.10, 0.25, 0.40]
+GRID_VOL_SHOCKS = [-2, 0, 2]
 
-        # common stuff
-        df_row['prc'] = 0.0025
-        df_row['acct'] = 'SQ'
-        df_row['blank'] = ''
+LEG_PRICE = 0.0025
+LEG_ACCOUNT = 'SQ'
 
-        df_row_p = df_row.copy()
-        df_row_c = df_row.copy()
+OUTPUT_COLS = ['q', 'm_abr', 'u_abr', 'x', 'pc', 'prc', 'blank', 'acct']
 
-        # different stuff
-        df_row_p['q'] = 1000
-        df_row_c['q'] = -1000
+SCENARIO_COLS = ['delta', 'vol_shock']
 
-        df_row_p['pc'] = 'P'
-        df_row_c['pc'] = 'C'
+OUTPUT_FILE_NAME = 'squash_input.csv'
+GRID_FILE_NAME = 'squash_input_grid.csv'
+SCENARIO_FILE_NAME = 'squash_input_d%02d_v%+g.csv'
 
-        df_row_p['x'] = tz_bls.eu_opt_strike_ED(u_prc, -0.25, m_vol, m_exp, R=None, Q=None)[0]
-        df_row_c['x'] = tz_bls.eu_opt_strike_ED(u_prc,  0.25, m_vol, m_exp, R=None, Q=None)[0]
+# Batch strikes must agree with tz_bls.eu_opt_strike_ED to within this when checked
+STRIKE_CHECK_TOLERANCE = 1e-8
 
-        return pd.concat([df_row_p, df_row_c], axis=1)
+# Every run checks a few of the strikes it writes against tz_bls.eu_opt_strike_ED, solving them
+# all with tz_bls instead if any is further off than this (cached strikes come from quantized
+# inputs, so this is looser than the full check)
+STRIKE_SPOT_CHECK_ROWS = 3
+STRIKE_SPOT_TOLERANCE = 0.001
 
-    sub_df_list = [calc_ed_strikes(df_row) for index, df_row in m_df.iterrows()]
+# Solved strikes are kept between runs, keyed on inputs rounded to these quanta (None for exact).
+# Strikes are solved from the rounded inputs, so a cached and a fresh strike are identical.
+STRIKE_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.tz_script_cache', 'squash_strikes.pkl')
+STRIKE_CACHE_MAX_ENTRIES = 20000
+STRIKE_CACHE_QUANTA = {'u_prc': 0.0001, 'vol': 0.0001, 't_exp': None}
 
-    df_out = pd.concat(sub_df_list, axis=1).T.reset_index(drop=True)
+# only compare the batch strike solver against tz_bls if told to
+CHECK_STRIKES = 'check' in sys.argv
 
-    # For QA purposes this is a pretty good view of the DF
-    # df_out = df_out[['u_abr', 'm_abr', 'skew_price', 'slope_vatm', 't_exp', 'q', 'pc', 'x']].sort_values(['t_exp', 'u_abr']).reset_index(drop=True)
+# only bypass the strike cache if told to
+USE_STRIKE_CACHE = 'nocache' not in sys.argv
 
-    # For output
-    df_out = df_out[['q', 'm_abr', 'u_abr', 'x', 'pc', 'prc', 'blank', 'acct']].reset_index(drop=True)
+# only stage the delta/vol shock grid if told to, as one combined file if told to
+GRID_MODE = 'grid' in sys.argv
+GRID_COMBINED = 'combined' in sys.argv
 
-    print(df_out)
+####### FUNCTIONS: TABLES ##########################################################################
 
-    df_out.to_csv(os.path.join(DROPBOX_PATH, 'squash_input.csv'), index=False, header=False)
+
+def select_rows_cols(table_df, columns=None, prefixes=None):
+
+    # Keeps rows whose columns start with the given prefixes, then the given columns
+    keep = pd.Series(True, index=table_df.index)
+
+    for col, prefix in (prefixes or {}).items():
+        keep &= table_df[col].astype(str).str.startswith(prefix)
+
+    table_df = table_df[keep]
+
+    return table_df[columns] if columns is not None else table_df
+
+
+def read_snapshot_table(table_path, columns=None, prefixes=None):
+
+    # One table CSV of a snapshot, only the given columns parsed and the rows filtered a chunk at
+    # a time so the whole table never sits in memory.  Raises ValueError if columns are missing.
+
+    read_cols = None if columns is None else set(columns) | set(prefixes or {})
+
+    if read_cols is not None:
+
+        missing = read_cols - set(pd.read_csv(table_path, nrows=0).columns)
+
+        if missing:
+            raise ValueError('%s has no %s columns' % (table_path, sorted(missing)))
+
+    chunks = pd.read_csv(table_path, usecols=None if read_cols is None else
+                         lambda col: col in read_cols,
+                         dtype={col: str for col in prefixes or {}},
+                         chunksize=SNAPSHOT_READ_CHUNK_ROWS)
+
+    return pd.concat([select_rows_cols(chunk, columns, prefixes) for chunk in chunks],
+                     ignore_index=True)
+
+
+def load_snapshot_table(table, columns=None, prefixes=None):
+
+    # Returns one table of the latest Happ DB snapshot, projected and filtered while it is read.
+    # The selection is cached locally under the table file and what was selected, so reruns
+    # against an unchanged snapshot read only the cached selection.  Only when no snapshot holds
+    # the table with those columns is the whole cleaned DB loaded through tz_happ_tables.
+
+    try:
+        snapshot_dir = tz_files.latest_file_from_template(SNAPSHOT_DIR_TEMPLATE)
+        table_path = os.path.join(snapshot_dir, SNAPSHOT_TABLE_FILE_NAME % table)
+
+        return cached_snapshot_table(table_path, table, columns, prefixes)
+
+    except (OSError, ValueError, TypeError) as e:
+        print('Loading the whole cleaned DB, no snapshot %s table to read: %s' % (table, e))
+
+    return select_rows_cols(tz_happ_tables.get_last_cleaned_db_dic()[table], columns, prefixes)
+
+
+def cached_snapshot_table(table_path, table, columns=None, prefixes=None):
+
+    # read_snapshot_table, cached under the selection and the table file's path and modified
+    # time, one snapshot per selection
+
+    selection = repr((table, columns, sorted((prefixes or {}).items())))
+    selection_hash = hashlib.md5(selection.encode('utf-8')).hexdigest()[:12]
+    path_hash = hashlib.md5(os.path.abspath(table_path).encode('utf-8')).hexdigest()[:12]
+
+    cache_prefix = os.path.join(SNAPSHOT_CACHE_DIR, '%s_%s_' % (table, selection_hash))
+    cache_path = cache_prefix + '%s_%d.pkl' % (path_hash, os.stat(table_path).st_mtime_ns)
+
+    if os.path.isfile(cache_path):
+        return pd.read_pickle(cache_path)
+
+    table_df = read_snapshot_table(table_path, columns, prefixes)
+
+    tz_files.ensure_dir_exists(SNAPSHOT_CACHE_DIR)
+
+    # the same selection of an older snapshot is stale
+    for stale_path in glob.glob(cache_prefix + '*.pkl'):
+        os.remove(stale_path)
+
+    table_df.to_pickle(cache_path + '.tmp')
+    os.replace(cache_path + '.tmp', cache_path)
+
+    return table_df
+
+####### FUNCTIONS ##################################################################################
+
+
+def eu_opt_strikes_ED(u_prc, deltas, vol, t_exp):
+
+    # Batch version of tz_bls.eu_opt_strike_ED with no rates: strikes for every delta of every
+    # underlying at once, shape (len(u_prc), len(deltas)).  ED options on price are options on
+    # the rate (100 - price) of the other type, so a -25 delta put on price is a 25 delta call
+    # on the rate and K = 100 - F * exp(-d1 * vol * sqrt(t) + vol^2 * t / 2).
+    # Conventions assumed from the tz_bls call it replaces (R=None, Q=None): vol is the Black-76
+    # lognormal vol of the rate as a decimal (slope_vatm / 100), t_exp is in years, nothing is
+    # discounted, and deltas are undiscounted forward deltas on price (puts negative).  Every
+    # run spot checks this against tz_bls, see squash_legs.
+
+    rate = 100 - np.asarray(u_prc, dtype=float)[:, None]
+    vol_sqrt_t = (np.asarray(vol, dtype=float) * np.sqrt(np.asarray(t_exp, dtype=float)))[:, None]
+
+    # d1 only depends on the delta, so invert the normal once per delta
+    rate_deltas = [-d for d in deltas]
+    d1 = np.array([NormalDist().inv_cdf(d if d > 0 else 1 + d) for d in rate_deltas])[None, :]
+
+    return 100 - rate * np.exp(-d1 * vol_sqrt_t + vol_sqrt_t ** 2 / 2)
+
+
+def scalar_strikes(u_prc, deltas, vol, t_exp, rows=None):
+
+    # tz_bls.eu_opt_strike_ED one strike at a time for the given rows (all if None)
+
+    rows = range(len(u_prc)) if rows is None else rows
+
+    return np.array([[tz_bls.eu_opt_strike_ED(u_prc[i], delta, vol[i], t_exp[i], R=None, Q=None)[0]
+                      for delta in deltas] for i in rows]).reshape(len(rows), len(deltas))
+
+
+def check_strikes(u_prc, deltas, vol, t_exp, strikes, rows=None):
+
+    # Returns the worst difference of strikes from the scalar tz_bls solver over the given rows
+    rows = np.arange(len(u_prc)) if rows is None else rows
+
+    if len(rows) == 0:
+        return 0.0
+
+    return float(np.abs(scalar_strikes(u_prc, deltas, vol, t_exp, rows) - strikes[rows]).max())
+
+
+def spot_check_rows(n_rows, n_checked=STRIKE_SPOT_CHECK_ROWS):
+    # first, last and evenly between
+    return np.unique(np.linspace(0, n_rows - 1, n_checked).astype(int)) if n_rows else []
+
+
+####### FUNCTIONS: STRIKE CACHE ####################################################################
+
+
+def quantize(values, quantum):
+
+    # Returns integer keys and the values they stand for, values themselves if quantum is None
+    values = np.asarray(values, dtype=float)
+
+    if quantum is None:
+        return values.tolist(), values
+
+    steps = np.round(values / quantum).astype(np.int64)
+
+    return steps.tolist(), steps * quantum
+
+
+def load_strike_cache(cache_path=STRIKE_CACHE_PATH):
+
+    # A missing cache, or one that no longer loads (truncated, or pickled by another pandas or
+    # numpy version), starts empty
+
+    try:
+        with open(cache_path, 'rb') as f:
+            entries = pickle.load(f)
+
+    except FileNotFoundError:
+        entries = OrderedDict()
+
+    except (IOError, ValueError, EOFError, AttributeError, ImportError, IndexError,
+            pickle.UnpicklingError) as e:
+        print('Starting an empty strike cache, %s is unreadable: %r' % (cache_path, e))
+        entries = OrderedDict()
+
+    if not isinstance(entries, OrderedDict):
+        entries = OrderedDict()
+
+    return {'entries': entries, 'hits': 0, 'misses': 0}
+
+
+def save_strike_cache(strike_cache, cache_path=STRIKE_CACHE_PATH):
+
+    tz_files.ensure_dir_exists(os.path.dirname(cache_path))
+
+    with open(cache_path + '.tmp', 'wb') as f:
+        pickle.dump(strike_cache['entries'], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def cached_eu_opt_strikes_ED(u_prc, deltas, vol, t_exp, strike_cache,
+                             quanta=STRIKE_CACHE_QUANTA, max_entries=STRIKE_CACHE_MAX_ENTRIES):
+
+    # eu_opt_strikes_ED through the strike cache: only underlyings with a (price, vol, time,
+    # delta) key not seen before are solved, least recently used keys are evicted past max_entries
+
+    entries = strike_cache['entries']
+
+    prc_keys, q_prc = quantize(u_prc, quanta['u_prc'])
+    vol_keys, q_vol = quantize(vol, quanta['vol'])
+    t_keys, q_t_exp = quantize(t_exp, quanta['t_exp'])
+
+    keys = [[(p, v, t, delta) for delta in deltas] for p, v, t in zip(prc_keys, vol_keys, t_keys)]
+
+    strikes = np.empty((len(keys), len(deltas)))
+    miss_rows = []
+
+    for i, row_keys in enumerate(keys):
+
+        if all(key in entries for key in row_keys):
+
+            for j, key in enumerate(row_keys):
+                strikes[i, j] = entries[key]
+                entries.move_to_end(key)
+
+            strike_cache['hits'] += len(deltas)
+
+        else:
+            miss_rows.append(i)
+
+    if len(miss_rows) > 0:
+
+        strikes[miss_rows] = eu_opt_strikes_ED(q_prc[miss_rows], deltas, q_vol[miss_rows],
+                                               q_t_exp[miss_rows])
+
+        for i in miss_rows:
+            for j, key in enumerate(keys[i]):
+                entries[key] = strikes[i, j]
+                entries.move_to_end(key)
+
+        strike_cache['misses'] += len(miss_rows) * len(deltas)
+
+    while len(entries) > max_entries:
+        entries.popitem(last=False)
+
+    return strikes
+
+####### FUNCTIONS: LEGS ############################################################################
+
+
+def squash_legs(m_df, deltas, vol_shocks, check=False, strike_cache=None):
+
+    # One row per vol shock, month, delta and leg (put then call), solved in a single batch
+
+    n_months = len(m_df)
+    n_shocks = len(vol_shocks)
+
+    leg_deltas = [sign * delta for delta in deltas for sign in (-1, 1)]
+    n_legs = len(leg_deltas)
+
+    # every month repeated for every shock
+    u_prc = np.tile(m_df['skew_price'].values.astype(float), n_shocks)
+    t_exp = np.tile(m_df['t_exp'].values.astype(float), n_shocks)
+    m_vol = (m_df['slope_vatm'].values.astype(float)[None, :] +
+             np.asarray(vol_shocks, dtype=float)[:, None]).ravel() / 100
+
+    if strike_cache is None:
+        strikes = eu_opt_strikes_ED(u_prc, leg_deltas, m_vol, t_exp)
+    else:
+        strikes = cached_eu_opt_strikes_ED(u_prc, leg_deltas, m_vol, t_exp, strike_cache)
+
+    # a few of the strikes to be written against tz_bls on every run, all of them if told to
+    spot_worst = check_strikes(u_prc, leg_deltas, m_vol, t_exp, strikes,
+                               spot_check_rows(len(u_prc)))
+
+    if spot_worst > STRIKE_SPOT_TOLERANCE:
+
+        print('FAILURE: batch strikes off tz_bls by %g on spot checked rows, solving every strike '
+              'with tz_bls instead' % spot_worst)
+
+        strikes = scalar_strikes(u_prc, leg_deltas, m_vol, t_exp)
+
+    if check:
+
+        # the solver on the exact inputs, and what quantizing the cache keys adds on top of it
+        exact_strikes = eu_opt_strikes_ED(u_prc, leg_deltas, m_vol, t_exp)
+        solver_worst = check_strikes(u_prc, leg_deltas, m_vol, t_exp, exact_strikes)
+        written_worst = check_strikes(u_prc, leg_deltas, m_vol, t_exp, strikes)
+        quantize_worst = float(np.abs(strikes - exact_strikes).max()) if len(strikes) else 0.0
+
+        status = {True: 'SUCCESS', False: 'FAILURE'}[solver_worst <= STRIKE_CHECK_TOLERANCE]
+        print('%s: batch strikes within %g of tz_bls (worst %g)' % (status, STRIKE_CHECK_TOLERANCE,
+                                                                     solver_worst))
+
+        status = {True: 'SUCCESS', False: 'FAILURE'}[written_worst <= STRIKE_SPOT_TOLERANCE]
+        print('%s: written strikes within %g of tz_bls (worst %g, of which cache quantization %g)'
+              % (status, STRIKE_SPOT_TOLERANCE, written_worst, quantize_worst))
+
+    legs_df = m_df.iloc[np.tile(np.repeat(np.arange(n_months), n_legs), n_shocks)]
+    legs_df = legs_df.reset_index(drop=True)
+
+    legs_df['vol_shock'] = np.repeat(vol_shocks, n_months * n_legs)
+    legs_df['delta'] = np.tile(np.repeat(deltas, len(LEG_PCS)), n_shocks * n_months)
+    legs_df['q'] = np.tile(LEG_QUANTITIES, n_shocks * n_months * len(deltas))
+    legs_df['pc'] = np.tile(LEG_PCS, n_shocks * n_months * len(deltas))
+    legs_df['x'] = strikes.ravel()
+    legs_df['prc'] = LEG_PRICE
+    legs_df['acct'] = LEG_ACCOUNT
+    legs_df['blank'] = ''
+
+    return legs_df
+
+####### SCRIPT #####################################################################################
+
+def run(check, grid, combined, use_strike_cache):
+
+    # pulling the eurodollars from the latest cleaned month table
+    m_df = load_snapshot_table('month', MONTH_COLS, MONTH_PREFIXES).reset_index(drop=True)
+
+    m_df['t_exp'] = (pd.to_datetime(m_df['dexp'], format='%Y-%m-%d') - dt.today()).dt.days / 365.25
+
+    strike_cache = load_strike_cache() if use_strike_cache else None
+
+    if not grid:
+
+        df_out = squash_legs(m_df, [SQUASH_DELTA], [0], check, strike_cache)
+
+        # For QA purposes this is a pretty good view of the DF
+        # df_out = df_out[['u_abr', 'm_abr', 'skew_price', 'slope_vatm', 't_exp', 'q', 'pc', 'x']].sort_values(['t_exp', 'u_abr']).reset_index(drop=True)
+
+        # For output
+        df_out = df_out[OUTPUT_COLS]
+
+        print(df_out)
+
+        df_out.to_csv(os.path.join(DROPBOX_PATH, OUTPUT_FILE_NAME), index=False, header=False)
+
+    else:
+
+        # every delta and vol shock from one batched solve
+        grid_df = squash_legs(m_df, GRID_DELTAS, GRID_VOL_SHOCKS, check, strike_cache)
+
+        if combined:
+
+            grid_path = os.path.join(DROPBOX_PATH, GRID_FILE_NAME)
+            grid_df[OUTPUT_COLS + SCENARIO_COLS].to_csv(grid_path, index=False, header=False)
+            print('%d legs written to %s' % (len(grid_df), grid_path))
+
+        else:
+
+            for (delta, vol_shock), scenario_df in grid_df.groupby(SCENARIO_COLS, sort=False):
+
+                scenario_file_name = SCENARIO_FILE_NAME % (round(100 * delta), vol_shock)
+                scenario_path = os.path.join(DROPBOX_PATH, scenario_file_name)
+                scenario_df[OUTPUT_COLS].to_csv(scenario_path, index=False, header=False)
+                print('%d legs written to %s' % (len(scenario_df), scenario_path))
+
+    if strike_cache is not None:
+
+        save_strike_cache(strike_cache)
+        print('Strike cache: %d hits, %d misses, %d entries' % (strike_cache['hits'],
+                                                                strike_cache['misses'],
+                                                                len(strike_cache['entries'])))
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    run(CHECK_STRIKES, GRID_MODE, GRID_COMBINED, USE_STRIKE_CACHE)
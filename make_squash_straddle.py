@@ -1,14 +1,20 @@
 # Standards
+import sys
 import os
+import time
+import datetime
 
 import numpy as np
 import pandas as pd
 
 import webbrowser
 
+from concurrent.futures import ThreadPoolExecutor
+
 # Locals
 from tz_interface import tz_dropbox, tz_gmail
 from tz_interface.tz_happ import tz_happ_auto
+from tz_script import squash_straddle_history
 
 DROPBOX_PATH = tz_dropbox.toStr()
 
@@ -25,97 +31,202 @@ HTML_FILE_PATH = os.path.join(DROPBOX_PATH, 'Daily Runs', 'Squash_Straddle_repor
 
 ADDT_COLS = ['g_code', 'ATMS_NEW', 'PS_NEW', 'CS_NEW', 'PS_SQ', 'CS_SQ', 'PS_R', 'CS_R']
 
-REMOVE_ERRORS = lambda x: x if np.isfinite(x) else 0
-
 MC_NAME_DICT = {'S': "Short", 'G': "Green", 'B': "Blue", 'F': "Gold", 'I': "Purple"}
 
 MC_DIFF_DICT = {'S': 1, 'G': 2, 'B': 3, 'F': 4, 'I': 5}
 
+PIVOT_VALUE_COLS = ['ATMS_NEW', 'PS_R', 'CS_R']
+PIVOT_KEY_COLS = ['exp_my_code', 'g_code']
+
+REPORT_NAMES = ['Straddle', 'Put Slope', 'Call Slope', 'All Data']
+
+# Watch mode: poll the risk reports and re-render when they change
+WATCH_POLL_SECONDS = 15
+
+# Risk reports dropped as text files, standing in for the Happ automation in watch mode
+RISK_REPORT_DIR = os.path.join(DROPBOX_PATH, 'Daily Runs', 'risk_reports')
+RISK_REPORT_FILE_NAMES = {'NEW': 'NEW.txt', 'SQ': 'SQ.txt'}
+
+# only keep the report running if told to, reading dropped report files if told to
+WATCH_MODE = 'watch' in sys.argv
+WATCH_FILES = 'files' in sys.argv
+
+# skip an output if told to (nohtml, noxlsx), stream the workbook in constant memory if told to
+REPORT_OUTPUTS = [output for output in ['html', 'xlsx'] if 'no' + output not in sys.argv]
+FAST_XLSX = 'fastxlsx' in sys.argv
+
+# keep every run's pivots in the local history unless told not to
+KEEP_HISTORY = 'nohistory' not in sys.argv
+
+# Stands in for the report body so tz_gmail's wrapper can be written around streamed tables
+HTML_BODY_MARKER = '<!--REPORT_BODY-->'
+
 
 ########## FUNCTIONS ###############################################################################
 
 
 def df_from_pwa_lines(raw_clipboard_lines):
 
-    # Extracting data from the pywinauto risk report data which comes in as clipboard lines
+    # Extracting data from the pywinauto risk report data which comes in as clipboard lines.
+    # One pass: data rows are the longest lines containing a '/', the header is the longest
+    # line without one.
 
-    data_rows_potential = [line for line in raw_clipboard_lines if '/' in line]
+    data_rows = []
+    data_row_length = -1
+    header_row = (-1, '')
 
-    max_row_length = max([len(x) for x in data_rows_potential])
+    for line in raw_clipboard_lines:
 
-    data_rows_filtered = [line for line in data_rows_potential if len(line) == max_row_length]
+        if '/' in line:
 
-    output_df = pd.DataFrame([line.split() for line in data_rows_filtered])
+            if len(line) > data_row_length:
+                data_row_length = len(line)
+                data_rows = [line]
 
-    # Extracting the column names from the pywin data
+            elif len(line) == data_row_length:
+                data_rows.append(line)
 
-    header_rows_potential = [line for line in raw_clipboard_lines if '/' not in line]
+        elif (len(line), line) > header_row:
+            header_row = (len(line), line)
 
-    _, header_row_filtered = max([(len(x), x) for x in header_rows_potential])
+    # Extracting the column names from the pywin data
 
-    column_names = [x.strip(' ') for x in header_row_filtered.split('  ') if x.strip() != '']
+    column_names = [x.strip(' ') for x in header_row[1].split('  ') if x.strip() != '']
 
     column_names.insert(0, 'MONTH')
     column_names[-1] = column_names[-1].replace('\r', '')
 
-    output_df.columns = column_names
-    output_df.rename(columns={'PUT SLP': 'PS', 'CLL SLP': 'CS'}, inplace=True)
+    # Splitting the data rows straight into one numeric array per column
+
+    data_cols = list(zip(*[line.split() for line in data_rows]))
 
-    output_df.set_index('MONTH', inplace=True)
+    if len(data_cols) != len(column_names):
+        raise ValueError('Risk report has %d columns but %d column names: %s' %
+                         (len(data_cols), len(column_names), column_names))
+
+    output_df = pd.DataFrame({name: pd.to_numeric(col, errors='coerce')
+                              for name, col in zip(column_names[1:], data_cols[1:])},
+                             index=pd.Index(data_cols[0], name='MONTH'),
+                             columns=column_names[1:])
+
+    output_df.rename(columns={'PUT SLP': 'PS', 'CLL SLP': 'CS'}, inplace=True)
 
     return output_df
 
 
-def get_g_code(df_row):
-    # Returns the mid curve gorup-code for display purposes
+def remove_errors(values):
+    # Zeroes out the non-finite entries (division by zero, missing SQ rows)
+    return values.where(np.isfinite(values), 0)
 
-    if df_row['is_front']:
-        return 'Front'
 
-    else:
-        return MC_NAME_DICT[df_row['happ_g_code']]
+def get_g_codes(dat):
+    # Returns the mid curve group-codes for display purposes
 
+    mc_names = dat['happ_g_code'].map(MC_NAME_DICT)
 
-def get_exp_my_code(df_row):
-    # Makes month-year code based on midcurve
+    unknown = ~dat['is_front'] & mc_names.isnull()
 
-    if df_row['is_front']:
-        return df_row['exp_m_code'] + str(df_row['u_yr'])
+    if unknown.any():
+        raise KeyError('Unknown mid curve group codes: %s' % list(dat.loc[unknown, 'happ_g_code']))
 
-    else:
-        int_year = int(df_row['u_yr']) - MC_DIFF_DICT[df_row['happ_g_code']]
-        return df_row['exp_m_code'] + str(int_year % 10)
+    return mc_names.where(~dat['is_front'], 'Front')
+
+
+def get_exp_my_codes(dat):
+    # Makes month-year codes based on midcurve: midcurve years go back by the group's offset
+
+    is_mc = ~dat['is_front']
+
+    exp_y_code = dat['u_yr'].copy()
+
+    mc_years = dat.loc[is_mc, 'u_yr'].astype(int) - dat.loc[is_mc, 'happ_g_code'].map(MC_DIFF_DICT)
+    exp_y_code[is_mc] = (mc_years % 10).astype(str)
+
+    return dat['exp_m_code'] + exp_y_code
 
 
 def make_unique(original_list):
     # returns unique list without affecting order of original
-    print(original_list)
-    unique_list = []
+    return list(dict.fromkeys(original_list))
+
+
+def month_group_cells(pre_pivot_df, pivot_value_cols):
+
+    # one (exp_my_code, g_code) cell per group for all value columns at once
+    return pre_pivot_df.groupby(PIVOT_KEY_COLS, sort=False)[pivot_value_cols].sum()
+
+
+def update_month_group_cells(cells, old_dat, new_dat, pivot_value_cols):
+
+    # Recomputes only the cells holding a month that was added, removed or changed between
+    # the two reports, the rest are carried over
 
-    [unique_list.append(obj) for obj in original_list if obj not in unique_list]
-    print(unique_list)
-    return unique_list
+    cols = PIVOT_KEY_COLS + pivot_value_cols
 
+    months = old_dat.index.union(new_dat.index)
+    old_rows = old_dat[cols].reindex(months)
+    new_rows = new_dat[cols].reindex(months)
 
-def month_group_pivot(pre_pivot_df, pivot_value_col):
+    same = (old_rows == new_rows) | (old_rows.isnull() & new_rows.isnull())
+    changed = ~same.all(axis=1)
 
-    indices_for_pivot = make_unique(pre_pivot_df['exp_my_code'])
-    columns_for_pivot = make_unique(pre_pivot_df['g_code'])
+    if not changed.any():
+        return cells
 
-    pivoted_df = pd.pivot_table(pre_pivot_df, values=pivot_value_col,
-                                index='exp_my_code', columns='g_code', aggfunc=np.sum, fill_value=0,
-                                margins=True, margins_name=TOTAL_LBL).round()
-    pivoted_df.index.names = [pivot_value_col]
+    affected = set()
 
-    mc_groups_in_df = [col for col in pivoted_df.columns if col in MC_NAME_DICT.values()]
-    pivoted_df[TOTAL_MIDCURVE_LBL] = pivoted_df[mc_groups_in_df].sum(axis=1)
+    for rows in [old_rows[changed], new_rows[changed]]:
+        affected.update(tuple(key) for key in rows[PIVOT_KEY_COLS].dropna().values)
 
-    pivoted_df = pivoted_df.reindex(columns=columns_for_pivot + [TOTAL_LBL, TOTAL_MIDCURVE_LBL],
-                                    index=indices_for_pivot + [TOTAL_LBL])
+    affected = list(affected)
 
-    pivoted_df.loc[TOTAL_LESS_NEXT_LBL] = (pivoted_df[1:-1].sum(axis=0))
+    in_affected = pd.MultiIndex.from_frame(new_dat[PIVOT_KEY_COLS]).isin(affected)
+    recomputed = month_group_cells(new_dat[in_affected], pivot_value_cols)
 
-    return pivoted_df
+    return pd.concat([cells[~cells.index.isin(affected)], recomputed])
+
+
+def pivots_from_cells(cells, indices_for_pivot, columns_for_pivot, pivot_value_cols):
+
+    # Lays each value column's cells out by expiration month-year and group, then adds the
+    # Grand Total, MC Total and w/o Next rows and columns
+
+    mc_groups_in_df = [col for col in columns_for_pivot if col in MC_NAME_DICT.values()]
+
+    cells = cells.unstack('g_code', fill_value=0)
+
+    pivoted_dfs = []
+
+    for pivot_value_col in pivot_value_cols:
+
+        pivoted_df = cells[pivot_value_col].reindex(index=indices_for_pivot,
+                                                    columns=columns_for_pivot, fill_value=0)
+
+        pivoted_df[TOTAL_LBL] = pivoted_df.sum(axis=1)
+        pivoted_df.loc[TOTAL_LBL] = pivoted_df.sum(axis=0)
+        pivoted_df = pivoted_df.round()
+
+        pivoted_df[TOTAL_MIDCURVE_LBL] = pivoted_df[mc_groups_in_df].sum(axis=1)
+
+        pivoted_df.loc[TOTAL_LESS_NEXT_LBL] = (pivoted_df[1:-1].sum(axis=0))
+
+        pivoted_df.index.name = pivot_value_col
+        pivoted_df.columns.name = 'g_code'
+
+        pivoted_dfs.append(pivoted_df)
+
+    return pivoted_dfs
+
+
+def month_group_pivots(pre_pivot_df, pivot_value_cols):
+
+    # Pivots every value column by expiration month-year and group off a single groupby,
+    # keeping rows and columns in first-seen order
+
+    return pivots_from_cells(month_group_cells(pre_pivot_df, pivot_value_cols),
+                             make_unique(pre_pivot_df['exp_my_code']),
+                             make_unique(pre_pivot_df['g_code']),
+                             pivot_value_cols)
 
 
 def output_to_excel(list_dfs, xls_path):
@@ -132,60 +243,223 @@ def output_to_excel(list_dfs, xls_path):
     writer.save()
 
 
-####### SCRIPT #####################################################################################
+def output_to_excel_fast(list_dfs, xls_path):
 
+    # Same side by side layout as output_to_excel, written row by row by xlsxwriter in constant
+    # memory mode (rows are flushed as soon as the next one starts)
+    import xlsxwriter
 
-def run():
+    blocks = []
+    df_start_col = 0
 
-    # Pulling clipboard lines from happ and extracting raw data
-    NEW_raw, SQ_raw = tz_happ_auto.get_account_risk_reports([tz_happ_auto.DOWN_TAPS['NEW'],
-                                                             tz_happ_auto.DOWN_TAPS['SQ']])
-    NEW_df = df_from_pwa_lines(NEW_raw)
-    SQ_df = df_from_pwa_lines(SQ_raw)
+    for df in list_dfs:
+
+        header = [df.index.name or ''] + [str(col) for col in df.columns]
+        rows = df.reset_index().values.tolist()
+
+        blocks.append((df_start_col, [header] + rows))
+        df_start_col += len(df.columns) + 2
+
+    workbook = xlsxwriter.Workbook(xls_path, {'constant_memory': True, 'nan_inf_to_errors': True})
+    worksheet = workbook.add_worksheet('Sheet1')
+
+    for row in range(max(len(block_rows) for _, block_rows in blocks)):
+        for start_col, block_rows in blocks:
+            if row < len(block_rows):
+                worksheet.write_row(2 + row, start_col, block_rows[row])
+
+    workbook.close()
+
+
+def output_to_html(report_names, report_tables, html_path, refresh_seconds=None):
+
+    # Streams one html table at a time into the report instead of building one big string,
+    # then swaps the finished file in for the one the browser has open
+
+    head, tail = tz_gmail.html_for_report(HTML_BODY_MARKER).split(HTML_BODY_MARKER)
+
+    with open(html_path + '.tmp', 'w') as html_file:
+
+        html_file.write(head)
+
+        # in watch mode the open tab reloads itself to pick up the re-rendered file
+        if refresh_seconds is not None:
+            html_file.write('<meta http-equiv="refresh" content="%d">' % refresh_seconds)
+
+        for report_name, report_table in zip(report_names, report_tables):
+            html_file.write(tz_gmail.html_table(report_name, report_table))
+
+        html_file.write(tail)
+
+    os.replace(html_path + '.tmp', html_path)
+
+
+def get_risk_report_lines():
+
+    # Pulling clipboard lines from happ
+    return tz_happ_auto.get_account_risk_reports([tz_happ_auto.DOWN_TAPS['NEW'],
+                                                  tz_happ_auto.DOWN_TAPS['SQ']])
+
+
+def read_risk_report_files(report_dir=RISK_REPORT_DIR):
+
+    # Same lines as get_risk_report_lines from NEW and SQ reports dropped as text files
+
+    report_lines = []
+
+    for account in ['NEW', 'SQ']:
+        with open(os.path.join(report_dir, RISK_REPORT_FILE_NAMES[account]), 'r', newline='') as f:
+            report_lines.append(f.read().split('\n'))
+
+    return report_lines
+
+
+def build_report_data(NEW_raw, SQ_raw):
+
+    # Parsing both reports at the same time
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        NEW_df, SQ_df = executor.map(df_from_pwa_lines, [NEW_raw, SQ_raw])
 
     # Merging into one df
-    dat = NEW_df.join(SQ_df, how='left', lsuffix='_NEW', rsuffix='_SQ').convert_objects(1, 1, 1)
+    dat = NEW_df.join(SQ_df, how='left', lsuffix='_NEW', rsuffix='_SQ')
 
     # Calculating equivalent put and call slopes
-    dat['PS_R'] = 1000 * (dat['PS_NEW'] / dat['PS_SQ']).map(REMOVE_ERRORS)
-    dat['CS_R'] = -1000 * (dat['CS_NEW'] / dat['CS_SQ']).map(REMOVE_ERRORS)
+    dat['PS_R'] = 1000 * remove_errors(dat['PS_NEW'] / dat['PS_SQ'])
+    dat['CS_R'] = -1000 * remove_errors(dat['CS_NEW'] / dat['CS_SQ'])
 
     # Helper columns for grouping
-    dat['u_yr'] = dat.index.map(lambda x: x[1:2])           # underlying year
-    dat['is_front'] = dat.index.map(lambda x: len(x) == 4)  # month code (U, V, SU, GU)
-    dat['happ_g_code'] = dat.index.map(lambda x: x[3])      # group
-    dat['exp_m_code'] = dat.index.map(lambda x: x[-1])      # month expiration (U, V, X, Z)
+    month_codes = dat.index.to_series().str
+    dat['u_yr'] = month_codes[1:2]                     # underlying year
+    dat['is_front'] = month_codes.len() == 4           # month code (U, V, SU, GU)
+    dat['happ_g_code'] = month_codes[3]                # group
+    dat['exp_m_code'] = month_codes[-1]                # month expiration (U, V, X, Z)
 
     # Pivot Table Columns
-    dat['g_code'] = dat.apply(get_g_code, axis=1)           # group code
-    dat['exp_my_code'] = dat.apply(get_exp_my_code, axis=1) # expiration month-year
-    #print(dat['g_code'])
-    #print(dat['exp_my_code'])
-    #print(dat)
-    # pivot tables
-    straddle_df = month_group_pivot(dat, 'ATMS_NEW')
-    putslope_df = month_group_pivot(dat, 'PS_R')
-    cllslope_df = month_group_pivot(dat, 'CS_R')
+    dat['g_code'] = get_g_codes(dat)                   # group code
+    dat['exp_my_code'] = get_exp_my_codes(dat)         # expiration month-year
+
+    return dat
+
+
+def render_report(dat, pivot_dfs, outputs, fast_xlsx, refresh_seconds=None, on_html_written=None):
 
-    # output to excel
-    output_to_excel([dat[ADDT_COLS], straddle_df, putslope_df, cllslope_df],
-                    xls_path=XLSX_FILE_PATH)
+    # Writes the workbook on a worker thread while the html is written here, so on_html_written
+    # (opening the browser) does not wait for the workbook
 
-    # output to html file and open file in browser
+    straddle_df, putslope_df, cllslope_df = pivot_dfs
 
-    report_names = ['Straddle', 'Put Slope', 'Call Slope', 'All Data']
-    report_tables = [straddle_df, putslope_df, cllslope_df, dat[ADDT_COLS]]
+    with ThreadPoolExecutor(max_workers=1) as executor:
 
-    html_code = ''
+        # output to excel
+        if 'xlsx' in outputs:
+            excel_writer = output_to_excel_fast if fast_xlsx else output_to_excel
+            xlsx_future = executor.submit(excel_writer,
+                                          [dat[ADDT_COLS], straddle_df, putslope_df, cllslope_df],
+                                          XLSX_FILE_PATH)
 
-    for report_name, report_table in zip(report_names, report_tables):
-        html_code += tz_gmail.html_table(report_name, report_table)
+        # output to html file
+        if 'html' in outputs:
 
-    with open(HTML_FILE_PATH, 'w') as html_file:
-        html_file.write(tz_gmail.html_for_report(html_code))
+            output_to_html(REPORT_NAMES, [straddle_df, putslope_df, cllslope_df, dat[ADDT_COLS]],
+                           HTML_FILE_PATH, refresh_seconds)
+
+            if on_html_written is not None:
+                on_html_written()
+
+        if 'xlsx' in outputs:
+            xlsx_future.result()
+
+
+def open_html_report():
 
     webbrowser.open('file://' + HTML_FILE_PATH)
 
 
+def watch(outputs, fast_xlsx, keep_history=True, poll_seconds=WATCH_POLL_SECONDS, report_dir=None,
+          max_polls=None):
+
+    # Polls the risk reports (Happ, or dropped files if report_dir is given) and re-renders the
+    # report whenever they change, recomputing only the pivot cells of months that moved.  A poll
+    # that fails (Happ hiccup, half-written report file, xlsx locked by Excel) is logged and the
+    # last good report kept, so the next poll retries it.
+
+    prev_lines = None
+    dat = cells = None
+    n_polls = 0
+
+    print('Watching %s every %d seconds, Ctrl+C to stop' % (report_dir or 'Happ risk reports',
+                                                            poll_seconds))
+
+    try:
+        while max_polls is None or n_polls < max_polls:
+
+            n_polls += 1
+
+            try:
+                if report_dir is None:
+                    lines = get_risk_report_lines()
+                else:
+                    lines = read_risk_report_files(report_dir)
+
+                if lines != prev_lines:
+
+                    new_dat = build_report_data(*lines)
+
+                    if cells is None:
+                        new_cells = month_group_cells(new_dat, PIVOT_VALUE_COLS)
+                    else:
+                        new_cells = update_month_group_cells(cells, dat, new_dat, PIVOT_VALUE_COLS)
+
+                    pivot_dfs = pivots_from_cells(new_cells, make_unique(new_dat['exp_my_code']),
+                                                  make_unique(new_dat['g_code']), PIVOT_VALUE_COLS)
+
+                    render_report(new_dat, pivot_dfs, outputs, fast_xlsx,
+                                  refresh_seconds=poll_seconds,
+                                  on_html_written=open_html_report if dat is None else None)
+
+                    # the report is out, so this poll's data is the one to diff against from now
+                    dat, cells, prev_lines = new_dat, new_cells, lines
+
+                    if keep_history:
+                        squash_straddle_history.append_snapshot(pivot_dfs)
+
+                    print('%s: report updated' % datetime.datetime.now().strftime('%H:%M:%S'))
+
+            except Exception as e:
+                print('%s: FAILURE: poll failed, keeping the last report (%s: %s)' %
+                      (datetime.datetime.now().strftime('%H:%M:%S'), type(e).__name__, e))
+
+            if max_polls is None or n_polls < max_polls:
+                time.sleep(poll_seconds)
+
+    except KeyboardInterrupt:
+        print('Stopped watching')
+
+
+####### SCRIPT #####################################################################################
+
+
+def run(outputs, fast_xlsx, keep_history=True):
+
+    # Pulling clipboard lines from happ and extracting raw data
+    dat = build_report_data(*get_risk_report_lines())
+
+    # pivot tables
+    pivot_dfs = month_group_pivots(dat, PIVOT_VALUE_COLS)
+
+    # output to excel and html file, opening the html in the browser as soon as it is written
+    render_report(dat, pivot_dfs, outputs, fast_xlsx, on_html_written=open_html_report)
+
+    # pivots into the history for trend queries
+    if keep_history:
+        squash_straddle_history.append_snapshot(pivot_dfs)
+
+
 if __name__ == '__main__':
-    run()
+
+    if WATCH_MODE:
+        watch(REPORT_OUTPUTS, FAST_XLSX, KEEP_HISTORY,
+              report_dir=RISK_REPORT_DIR if WATCH_FILES else None)
+
+    else:
+        run(REPORT_OUTPUTS, FAST_XLSX, KEEP_HISTORY)
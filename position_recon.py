@@ -0,0 +1,156 @@
+# Position reconciliation by hash join: both sides summed onto one keyed index per account split,
+# every account grouping compared from that single pass
+
+# Standards
+import numpy as np
+import pandas as pd
+
+################## CONSTANTS #######################################################################
+
+SPLIT_COL = 'split'
+OTHER_SPLIT = 'OTHER'
+
+# suffixes of each side's values in the joined table
+TZ_SUFFIX = '_tz'
+WB_SUFFIX = '_wb'
+DIFF_SUFFIX = '_diff'
+
+BREAK_COUNT_COLS = ['keys', 'breaks', 'tz_only', 'wb_only']
+
+################## FUNCTIONS #######################################################################
+
+
+def assign_splits(pos_df, split_conditions):
+
+    # Split of each row: the first split whose conditions ({column: allowed values}, all must
+    # hold) the row meets, OTHER if none
+
+    matches = [np.logical_and.reduce([pos_df[col].isin(values).values
+                                      for col, values in conditions.items()])
+               for conditions in split_conditions.values()]
+
+    return np.select(matches, list(split_conditions), default=OTHER_SPLIT).astype(object)
+
+
+def normalized_keys(key_array):
+
+    # Key values of both sides as one type, so a strike read as 97.5 on one side and '97.50' on
+    # the other is one key: numbers if every value present reads as one, stripped strings
+    # otherwise.  Missing values stay missing.
+
+    values = pd.Series(key_array, dtype=object)
+    present = values.notna()
+
+    numbers = pd.to_numeric(values, errors='coerce')
+
+    if (numbers.notna() == present).all():
+        return numbers.values
+
+    return values.astype(str).str.strip().where(present, np.nan).values
+
+
+def break_keys(breaks_df, key_cols):
+
+    # Set of the key tuples of a table of breaks, normalized as in the join, to compare engines
+    key_df = pd.DataFrame({col: normalized_keys(breaks_df[col].values) for col in key_cols})
+
+    return set(key_df.astype(object).where(key_df.notna(), None).itertuples(index=False,
+                                                                             name=None))
+
+
+def key_codes(key_arrays):
+
+    # One integer per distinct combination of the key arrays (NaN a value like any other), and
+    # how many there are.  Each column is hashed once, the codes combined a column at a time.
+
+    codes, n_codes = np.zeros(len(key_arrays[0]), dtype=np.int64), 1
+
+    for key_array in key_arrays:
+
+        col_codes, uniques = pd.factorize(key_array)
+        codes, uniques = pd.factorize(codes * (len(uniques) + 1) + (col_codes + 1))
+        n_codes = len(uniques)
+
+    return codes, n_codes
+
+
+def joined_index(tz_df, wb_df, key_cols, value_cols, fill_values, tz_splits, wb_splits):
+
+    # One row per (split, key) held by either side, each side's values summed onto it and missing
+    # values filled.  Both sides are hashed together once and summed with bincount, each key
+    # column normalized to one type across the sides first.
+
+    n_tz = len(tz_df)
+
+    splits = np.concatenate([assign_splits(tz_df, tz_splits), assign_splits(wb_df, wb_splits)])
+    key_arrays = [splits] + [normalized_keys(np.concatenate([np.asarray(pos_df[col].values, object)
+                                                             for pos_df in [tz_df, wb_df]]))
+                             for col in key_cols]
+
+    codes, n_codes = key_codes(key_arrays)
+
+    # first row of each key, for its key values
+    first_rows = np.empty(n_codes, dtype=np.int64)
+    first_rows[codes[::-1]] = np.arange(len(codes))[::-1]
+
+    joined = pd.DataFrame({col: key_array[first_rows]
+                           for col, key_array in zip([SPLIT_COL] + key_cols, key_arrays)})
+
+    for suffix, side_codes in [(TZ_SUFFIX, codes[:n_tz]), (WB_SUFFIX, codes[n_tz:])]:
+        joined[suffix] = np.bincount(side_codes, minlength=n_codes) > 0
+
+    for col, fill_value in zip(value_cols, fill_values):
+        for suffix, pos_df, side_codes in [(TZ_SUFFIX, tz_df, codes[:n_tz]),
+                                           (WB_SUFFIX, wb_df, codes[n_tz:])]:
+
+            values = np.bincount(side_codes, weights=pos_df[col].values.astype(float),
+                                 minlength=n_codes)
+
+            # a side holding nothing under a key has the fill value there
+            joined[col + suffix] = np.where(joined[suffix].values, values, fill_value)
+
+            if pos_df[col].dtype.kind in 'iu':
+                joined[col + suffix] = joined[col + suffix].round().astype(np.int64)
+
+    return joined
+
+
+def reconcile(tz_df, wb_df, key_cols, value_cols, fill_values, tz_splits, wb_splits, groups):
+
+    # Compares every group (name: list of splits, None for all) of the two position dfs.  Returns
+    # {group: rows whose values differ} and the break counts per group.
+
+    joined = joined_index(tz_df, wb_df, key_cols, value_cols, fill_values, tz_splits, wb_splits)
+
+    value_side_cols = [col + suffix for col in value_cols for suffix in [TZ_SUFFIX, WB_SUFFIX]]
+
+    breaks, break_counts = {}, []
+
+    for group, splits in groups.items():
+
+        group_df = joined if splits is None else joined[joined[SPLIT_COL].isin(splits)]
+
+        # a group of several splits compares their sums
+        if splits is None or len(splits) > 1:
+            group_df = group_df.groupby(key_cols, sort=False, dropna=False).agg(
+                {**{col: 'sum' for col in value_side_cols}, TZ_SUFFIX: 'any', WB_SUFFIX: 'any'})
+            group_df = group_df.reset_index()
+
+        else:
+            group_df = group_df.drop(columns=SPLIT_COL)
+
+        for col in value_cols:
+            group_df[col + DIFF_SUFFIX] = group_df[col + TZ_SUFFIX] - group_df[col + WB_SUFFIX]
+
+        is_break = np.logical_or.reduce([group_df[col + DIFF_SUFFIX].values != 0
+                                         for col in value_cols])
+
+        group_breaks = group_df[is_break]
+
+        breaks[group] = group_breaks.drop(columns=[TZ_SUFFIX, WB_SUFFIX]).reset_index(drop=True)
+        break_counts.append([len(group_df), len(group_breaks),
+                             int((~group_breaks[WB_SUFFIX]).sum()),
+                             int((~group_breaks[TZ_SUFFIX]).sum())])
+
+    return breaks, pd.DataFrame(break_counts, index=pd.Index(list(groups), name='group'),
+                                columns=BREAK_COUNT_COLS)
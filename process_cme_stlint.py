@@ -1,13 +1,18 @@
 # Download and parse CME settles for import into Happ
 
 # Standards
+import sys
 import os
+import json
+import time
+import ftplib
+import pickle
+import hashlib
 import pandas as pd
 
-from csv import QUOTE_NONE
-
 # Locals
 from tz_interface import tz_cme, tz_dropbox
+from tz_script import cme_settle_store
 
 ################## CONSTANTS #######################################################################
 
@@ -15,191 +20,446 @@ DROPBOX_PATH = tz_dropbox.toStr()
 
 OUTPUT_FILE_PATH = os.path.join(DROPBOX_PATH, 'settles.txt')
 
+DELTA_FILE_PATH = os.path.join(DROPBOX_PATH, 'settles_delta.txt')
+
 DOWNLOAD_FILE_PATH = os.path.join(DROPBOX_PATH, 'stlint')
 
 CME_PUBLIC_FTP_URL = 'ftp.cmegroup.com'
 
+# A stalled CME FTP gives up on the stat after this long and the run goes on to the download
+CME_FTP_TIMEOUT_SECONDS = 60
+
+# Parsed stlint tables are kept locally (not in Dropbox) so reruns can skip the download and parse
+LOCAL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.tz_script_cache')
+STLINT_CACHE_DIR = os.path.join(LOCAL_CACHE_DIR, 'stlint')
+STLINT_CACHE_MAX_ENTRIES = 10
+
+# only bypass the cache if told to
+USE_CACHE = 'nocache' not in sys.argv
+
+# only write the changed settles if told to
+WRITE_DELTA = 'delta' in sys.argv
+
+# Parsed settlement table, built once by the parser and used by every later stage
+SETTLE_DTYPES = {'Prod': 'category',   # stlint product code.  Ex: ED, ZE, E0
+                 'Month': 'category',  # expiration month letter.  Ex: U
+                 'Year': 'int8',       # expiration year.  Ex: 17
+                 'CP': 'uint8',        # one-byte call/put flag, see CP_FLAGS
+                 'Strike': 'int32',    # stlint strike, 0 for futures
+                 'Price': 'category'}  # settle as written in stlint.  Ex: .0150
+
+SETTLES_COLUMNS = ['Underlying', 'HappProd', 'X', 'CP', 'Price']
+
+# A settle is identified by everything but its price, and by how many rows with the same columns
+# came before it in the file: weeklys of different expiry months share Underlying and HappProd
+# (Ex: "EDH18" "S1" for both JAN18 and FEB18), and stlint lists them in month order
+SETTLES_KEY_COLUMNS = ['Underlying', 'HappProd', 'X', 'CP']
+
+# Switch the keys for values to go from stlint product code to Happ code.  Ex: E0 becomes S
+STLINT_TO_HAPP_PROD = {v: k for k, v in tz_cme.o_ed_midcurve.items()}
+
+# Years between a midcurve's expiration and its underlying future
+MIDCURVE_YEAR_OFFSET = dict([(p, 1) for p in ['S', 'S1', 'S2', 'S3', 'S4', 'S5']] +
+                            [(p, 2) for p in ['G', 'G1', 'G2', 'G3', 'G4', 'G5']] +
+                            [(p, 3) for p in ['B', 'B1', 'B2', 'B3', 'B4', 'B5']] +
+                            [('F', 4), ('I', 5)])
+
+# Midcurve codes whose non-weekly contracts take the month after.  Ex: G and H become GH
+WEEKLY_BASE_PRODS = ['S', 'G', 'B', 'F', 'I']
+
+# Call/put flag stored in the settlement table, futures have neither
+CP_FLAGS = {'CALL': ord('C'), 'PUT': ord('P'), '': ord(' ')}
+
+# This is third column of settles.txt
+CP_CODES = {flag: '"%s"' % chr(flag) for flag in CP_FLAGS.values()}
+
 ################## FUNCTIONS #######################################################################
 
 
-def process_stlint_lines(lines):
+def iter_stlint_records(lines):
 
-    # read the lines and append into a list
-    data_nested_lists = []
+    # Yields one typed (product, contract month, call/put, strike, settle) record per settle row.
+    # Lines are consumed one at a time so a file handle can be passed straight in.
     key = ''
+    contract = ''
+    cp = ''
 
     for line in lines:
 
-        if len(line.strip()) == 0:
+        tokens = line.split()
 
-            continue
+        if len(tokens) == 0:
 
-        tokens = [t for t in line.split() if len(t.strip()) > 0]
+            continue
 
-        if tokens[0].rstrip(' ') == 'TOTAL':
+        if tokens[0] == 'TOTAL':
 
             key = ''  # If reach total in stlint, do not append
 
-        if key != '':
+        if key == 'ED':
 
-            if key == 'ED':
+            # handles different header from the futures section: month leads the row, no strike
+            yield key, tokens[0], '', 0, tokens[5]
 
-                col = [key, tokens[0], 0]  # handles different header from the futures section
-                data_nested_lists.append(col + tokens)
+        elif key != '':
 
-            else:  # strike always begins with a 9 or 1
+            # strike always begins with a 9 or 1
+            if (len(tokens[0]) > 3) and (tokens[0][0] in ('9', '1')):
 
-                if (len(tokens[0]) > 3) and ((tokens[0][:1] == '9') or (tokens[0][:1] == '1')):
+                yield key, contract, cp, int(tokens[0]), tokens[5]
 
-                    data_nested_lists.append(col + tokens)
+            else:
 
-                else:
-
-                    key = ''
+                key = ''
 
         if tokens[0] in tz_cme.cme_stlint_lst:
             key = tokens[0]
-            col = [tokens[0], tokens[1], tokens[len(tokens) - 1]]
+            contract = tokens[1]
+            cp = tokens[len(tokens) - 1]
+
+
+def process_stlint_lines(lines):
+
+    # Fill one buffer per column straight from the record stream
+    buffers = tuple([] for _ in SETTLE_DTYPES)
+    prods, months, years, cps, strikes, prices = [buf.append for buf in buffers]
+
+    # Each distinct contract is split only once.  Ex: SEP17 becomes U and 17
+    contract_split = {}
+
+    for prod, contract, cp, strike, price in iter_stlint_records(lines):
+
+        if contract not in contract_split:
+            mon, yr = contract[0:3], int(contract[3:5])
+            contract_split[contract] = (tz_cme.cme_stlint_month_dic.get(mon, mon), yr)
+
+        month, year = contract_split[contract]
+
+        prods(prod)
+        months(month)
+        years(year)
+        cps(CP_FLAGS[cp])
+        strikes(strike)
+        prices(price)
 
     # Create the dataframe
-    return pd.DataFrame(data_nested_lists)
+    return pd.DataFrame({col: pd.Series(buf, dtype=dtype)
+                         for (col, dtype), buf in zip(SETTLE_DTYPES.items(), buffers)})
 
-# Handle weeklys by not adding the month after.
-# Ex: G1 stays as G1 instead of G1H. G and H still become GH
 
+str_strip_right = lambda x: str(x).rstrip('0').rstrip('.')
 
-def weekly(data_df_row):
 
-    if data_df_row['Prod'] in ['S', 'G', 'B', 'F', 'I']:
+def format_unique(series):
 
-        # Need to handle for front F which was getting processed as a gold "F"
-        if data_df_row['Year'] == data_df_row['undYear']:
+    # Formats each distinct value once and maps the strings back over the whole column
+    return series.map({value: str_strip_right(value) for value in series.unique()})
 
-            return '"' + data_df_row['Prod'] + '"'
 
-        else:
+def contract_columns(prod, month, year):
 
-            return '"' + data_df_row['Prod'] + data_df_row['Month'] + '"'
-    else:
+    # Returns the settles.txt Underlying and HappProd columns for contracts given as
+    # stlint product code, month letter and year
 
-        return '"' + data_df_row['Prod'] + '"'
+    prod = prod.replace(STLINT_TO_HAPP_PROD)
 
-# Returns corresponding underlying for Midcurves. Ex: For shorts, 16 as year of expiration
-# returns 17 as underlying
+    filt_ED = prod == 'ED'
 
+    # Correct underlying year for midcurves.  Ex: Shorts that expire in 16, under is 17
+    und_year = year + prod.map(MIDCURVE_YEAR_OFFSET).fillna(0).astype(int)
 
-def midcurve_underlying(data_df_row):
+    # Fronts, reds and longs changed from ZE
+    prod = prod.mask(prod == 'ZE', month)
 
-    pr = data_df_row['Prod']
-    yr = data_df_row['Year']
+    # Change underlying to correct month for serials.  Ex: F, G become H. J, K become M, etc.
+    und_month = month.map(tz_cme.cme_ed_expiration_to_underlying_dict).fillna(month)
+    und_month = und_month.mask(filt_ED, month)
 
-    if pr in ['ED', 'ZE']:
-        mu = yr
+    # Change ED to "".  Happ requires "" for futures
+    prod = prod.mask(filt_ED, '""')
 
-    elif pr in ['S', 'S1', 'S2', 'S3', 'S4', 'S5']:
-        mu = yr + 1
+    # Weeklys keep their code (G1 stays G1) and fronts keep theirs, other midcurves get the month
+    add_month = prod.isin(WEEKLY_BASE_PRODS) & (year != und_year)
+    happ_prod = '"' + prod + month.where(add_month, '') + '"'
 
-    elif pr in ['G', 'G1', 'G2', 'G3', 'G4', 'G5']:
-        mu = yr + 2
+    return '"ED' + und_month + und_year.astype(str) + '"', happ_prod
 
-    elif pr in ['B', 'B1', 'B2', 'B3', 'B4', 'B5']:
-        mu = yr + 3
 
-    elif pr == 'F':
-        mu = yr + 4
+def transform_settles(settle_df):
 
-    elif pr == 'I':
-        mu = yr + 5
+    # Turns the parsed settlement table into the five settles.txt columns
 
-    else:
-        mu = yr
+    # Underlying and HappProd only depend on the contract, so work out each distinct one once
+    contract_cols = ['Prod', 'Month', 'Year']
+    contract_codes, contracts = pd.MultiIndex.from_frame(settle_df[contract_cols]).factorize()
+    contracts = pd.DataFrame(contracts.tolist(), columns=contract_cols)
 
-    return mu
+    underlying, happ_prod = contract_columns(contracts['Prod'].astype(str),
+                                             contracts['Month'].astype(str),
+                                             contracts['Year'].astype(int))
 
-str_strip_right = lambda x: str(x).rstrip('0').rstrip('.')
+    # Strike format, futures have no strike
+    strike_x = format_unique(round(0.08 * settle_df['Strike']) / 8)
+    strike_x = strike_x.mask(settle_df['Prod'] == 'ED', '0')
 
-####################################################################################################
-################## SCRIPT START ####################################################################
-####################################################################################################
+    return pd.DataFrame({'Underlying': underlying.values.take(contract_codes),
+                         'HappProd': happ_prod.values.take(contract_codes),
+                         'X': strike_x.values,
+                         'CP': settle_df['CP'].map(CP_CODES).values,
+                         'Price': format_unique(settle_df['Price']).astype(object).values},
+                        columns=SETTLES_COLUMNS)
 
 
-def run():
+def write_settles(settles_df, output_path):
 
-    # Download the settles file from CME FTP site
-    tz_cme.public_ftp_directory_download(local_directory=DROPBOX_PATH,
-                                         ftp_directory='settle',
-                                         white_list=['stlint'],
-                                         force_download=True)
+    # Writes the settles.txt columns tab separated, one row per line, to a temp file next to the
+    # output and renames it into place so Happ never picks up a half-written file
+    tmp_path = output_path + '.tmp'
 
-    # create own csv with List
-    with open(DOWNLOAD_FILE_PATH, 'r') as f:
-        lines = f.readlines()
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.writelines('\t'.join(row) + '\n'
+                     for row in zip(*[settles_df[col].values for col in SETTLES_COLUMNS]))
 
-    data_raw_df = process_stlint_lines(lines)
+    os.replace(tmp_path, output_path)
 
-    # Split up second column into two columns.  Ex: SEP17 becomes SEP and 17
-    data_raw_df['mon'] = data_raw_df[1].str[0:3]
-    data_raw_df['yr'] = data_raw_df[1].str[3:5].astype(int)
 
-    # Subsetting and renaming columns
-    data_df = data_raw_df[[0, 'mon', 'yr', 2, 3, 8]]
-    data_df.columns = ['Prod', 'Month', 'Year', 'CP', 'Strike', 'Price']
+def read_settles(settles_path):
 
-    # Switch the keys for values to line up for the dataframe
-    swap_dict = {v: k for k, v in tz_cme.o_ed_midcurve.items()}
-    data_df['Prod'].replace(swap_dict, inplace=True)
+    # Returns {(Underlying, HappProd, X, CP, occurrence): Price} from a previously written
+    # settles.txt, occurrence counting earlier rows with the same columns
 
-    # Replace month with letter.  EX: AUG becomes Q,  SEP becomes U
-    data_df['Month'].replace(tz_cme.cme_stlint_month_dic, inplace=True)
+    previous = {}
+    occurrences = {}
 
-    # use function to get the correct underlying for midcurves.  Ex: Shorts
-    # that expire in 16, under is 17
-    data_df['undYear'] = data_df.apply(midcurve_underlying, axis=1)
+    if not os.path.isfile(settles_path):
+        return previous
 
-    # Fronts, reds and longs changed from ZE
-    filt_ZE = data_df['Prod'] == 'ZE'
-    data_df.loc[filt_ZE, 'Prod'] = data_df[filt_ZE]['Month']
+    with open(settles_path, 'r', encoding='utf-8') as f:
+        for line in f:
 
-    # Change underlying to correct month for serials.  Ex: F, G become H. J, K become M, etc.
-    data_df['undMonth'] = data_df['Month'].replace(tz_cme.cme_ed_expiration_to_underlying_dict)
-    filt_ED = data_df['Prod'] == 'ED'
-    data_df.loc[filt_ED, 'undMonth'] = data_df[filt_ED]['Month']
+            row = line.rstrip('\n').split('\t')
 
-    # first column:
-    data_df['Underlying'] = '"ED' + data_df['undMonth'].map(str) + data_df['undYear'].map(str) + '"'
+            if len(row) == len(SETTLES_COLUMNS):
 
-    # Change ED to "".  Happ requires "" for futures
-    data_df.loc[filt_ED, 'Prod'] = '""'
+                key = tuple(row[:-1])
+                occurrences[key] = occurrences.get(key, -1) + 1
+
+                previous[key + (occurrences[key],)] = row[-1]
+
+    return previous
+
+
+def settles_delta(settles_df, previous):
+
+    # Returns the rows that are new or have a different price than in previous, and the counts
+
+    occurrences = settles_df.groupby(SETTLES_KEY_COLUMNS, sort=False).cumcount()
+
+    keys = list(zip(*[settles_df[col].values for col in SETTLES_KEY_COLUMNS],
+                    occurrences.values))
+    prev_prices = pd.Series([previous.get(key) for key in keys], index=settles_df.index)
+
+    is_added = prev_prices.isnull()
+    is_changed = ~is_added & (settles_df['Price'] != prev_prices)
+
+    summary = {'added': int(is_added.sum()),
+               'changed': int(is_changed.sum()),
+               'unchanged': int((~is_added & ~is_changed).sum()),
+               'removed': len(previous.keys() - set(keys))}
+
+    return settles_df[is_added | is_changed], summary
+
+
+def load_stlint(stlint_path):
+
+    # parse the settles straight from the file handle, one line at a time
+    with open(stlint_path, 'r') as f:
+        return process_stlint_lines(f)
+
+################## FUNCTIONS: CACHE ################################################################
+
+
+def stlint_remote_stat(host=CME_PUBLIC_FTP_URL, ftp_directory='settle', file_name='stlint',
+                       port=21, timeout=CME_FTP_TIMEOUT_SECONDS):
+
+    # Returns (size, modification time) of the remote file, or None if the server will not say
+
+    try:
+        ftp = ftplib.FTP(timeout=timeout)
+        ftp.connect(host, port)
+
+        try:
+            ftp.login()
+            ftp.cwd(ftp_directory)
+            ftp.voidcmd('TYPE I')  # SIZE is only reliable in binary mode
+            size = ftp.size(file_name)
+            mtime = ftp.sendcmd('MDTM ' + file_name).split()[-1]
+
+        finally:
+            ftp.close()
+
+    except ftplib.all_errors as e:
+        print('Could not stat %s/%s on %s: %s' % (ftp_directory, file_name, host, e))
+        return None
+
+    return size, mtime
+
+
+def file_sha256(file_path, chunk_size=1 << 20):
+
+    sha = hashlib.sha256()
+
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def read_cache_index(cache_dir=STLINT_CACHE_DIR):
+
+    try:
+        with open(os.path.join(cache_dir, 'index.json'), 'r') as f:
+            return json.load(f)
+
+    except (IOError, ValueError):
+        return []
+
+
+def write_cache_index(entries, cache_dir=STLINT_CACHE_DIR):
+
+    # write then rename so a crashed run never leaves a half-written index behind
+    index_path = os.path.join(cache_dir, 'index.json')
+
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(entries, f, indent=1)
+
+    os.replace(index_path + '.tmp', index_path)
+
+
+def cache_lookup(remote_stat=None, content_hash=None, cache_dir=STLINT_CACHE_DIR):
+
+    # Returns the cached parsed table matching the remote stat or the content hash, else None.
+    # Unreadable entries are dropped from the index and the remaining ones tried.
+
+    entries = read_cache_index(cache_dir)
+
+    for entry in list(entries):
+
+        stat_hit = remote_stat is not None and entry['stat'] == list(remote_stat)
+        hash_hit = content_hash is not None and entry['sha256'] == content_hash
+
+        if stat_hit or hash_hit:
+
+            try:
+                settle_df = pd.read_pickle(os.path.join(cache_dir, entry['file']))
+            except (IOError, ValueError, EOFError, AttributeError, ImportError,
+                    pickle.UnpicklingError) as e:
+                print('Dropping unreadable stlint cache entry %s: %r' % (entry['file'], e))
+
+                entries.remove(entry)
+                write_cache_index(entries, cache_dir)
+                continue
+
+            # tables pickled before a schema change are parsed again
+            if settle_df.dtypes.astype(str).to_dict() != SETTLE_DTYPES:
+                continue
+
+            # mark as recently used so eviction keeps it
+            entry['used'] = time.time()
+            write_cache_index(entries, cache_dir)
+
+            return settle_df
+
+    return None
+
+
+def cache_store(remote_stat, content_hash, settle_df, cache_dir=STLINT_CACHE_DIR,
+                max_entries=STLINT_CACHE_MAX_ENTRIES):
+
+    # Adds the parsed table under its remote stat and content hash, evicting least recently used
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    entries = [e for e in read_cache_index(cache_dir) if e['sha256'] != content_hash]
+
+    file_name = content_hash + '.pkl'
+    settle_df.to_pickle(os.path.join(cache_dir, file_name))
+
+    entries.append({'stat': list(remote_stat) if remote_stat is not None else None,
+                    'sha256': content_hash,
+                    'file': file_name,
+                    'used': time.time()})
+
+    entries.sort(key=lambda e: e['used'], reverse=True)
+
+    for entry in entries[max_entries:]:
+
+        try:
+            os.remove(os.path.join(cache_dir, entry['file']))
+        except OSError:
+            pass
+
+    write_cache_index(entries[:max_entries], cache_dir)
+
+####################################################################################################
+################## SCRIPT START ####################################################################
+####################################################################################################
+
+
+def run(use_cache, write_delta):
+
+    # If CME has not republished stlint since the last run, reuse the parsed table
+    remote_stat = stlint_remote_stat() if use_cache else None
+    settle_df = cache_lookup(remote_stat=remote_stat) if remote_stat is not None else None
+
+    if settle_df is not None:
+
+        print('stlint unchanged on CME FTP %s, using cached settles' % (remote_stat,))
+
+    else:
+
+        # Download the settles file from CME FTP site
+        tz_cme.public_ftp_directory_download(local_directory=DROPBOX_PATH,
+                                             ftp_directory='settle',
+                                             white_list=['stlint'],
+                                             force_download=True)
+
+        content_hash = file_sha256(DOWNLOAD_FILE_PATH)
+
+        # Same bytes can be republished under a new timestamp
+        settle_df = cache_lookup(content_hash=content_hash) if use_cache else None
 
-    # Change product code from E0,  E2,  etc to S,  G,  B,  etc.
-    data_df['HappProd'] = data_df.apply(weekly, axis=1)
+        if settle_df is None:
+            settle_df = load_stlint(DOWNLOAD_FILE_PATH)
 
-    # This is third column of settles.txt Replace CALL with C, etc.
-    data_df['CP'].replace({'CALL': '"C"', 'PUT': '"P"', 0: '" "'}, inplace=True)
+        if use_cache:
+            cache_store(remote_stat, content_hash, settle_df)
 
-    # This is a fudge. We do a division in the next couple lines of code to get correct strike format
-    # This makes sure we are not dividing by 0. Later we will set this to "" again.
-    data_df.loc[data_df['Prod'] == '""', 'Strike'] = 1000
+        # Keep the day's settles in the local history
+        trade_date = cme_settle_store.stlint_trade_date(DOWNLOAD_FILE_PATH)
+        cme_settle_store.write_day(trade_date, settle_df)
+        print('Settles for %s added to %s' % (trade_date, cme_settle_store.SETTLE_STORE_DIR))
 
-    # Create fourth column, strike for settles.txt
-    data_df['X'] = (round(0.08 * data_df['Strike'].astype(int)) / 8).map(str_strip_right)
+    # Build the settles.txt columns
+    settles_df = transform_settles(settle_df)
 
-    # Set strike for futures back to 0
-    data_df.loc[data_df['Prod'] == '""', 'X'] = 0
+    # Only the settles that moved since the last written file
+    if write_delta:
 
-    # Remove trailing 0's from price
-    data_df['Price'] = data_df['Price'].map(str_strip_right)
+        delta_df, summary = settles_delta(settles_df, read_settles(OUTPUT_FILE_PATH))
+        write_settles(delta_df, DELTA_FILE_PATH)
 
-    # Create dataframe with columns we made
-    data_final_df = data_df[['Underlying', 'HappProd', 'X', 'CP', 'Price']]
+        print('Settles delta: %(added)d added, %(changed)d changed, %(unchanged)d unchanged, '
+              '%(removed)d removed' % summary)
 
     # Write to file
-    data_final_df.to_csv(OUTPUT_FILE_PATH, sep='\t', encoding='utf-8',
-                         index=False, header=False, quoting=QUOTE_NONE)
+    write_settles(settles_df, OUTPUT_FILE_PATH)
 
 ####################################################################################################
 ################## SCRIPT END ######################################################################
 ####################################################################################################
 
 if __name__ == '__main__':
-    run()
+    run(USE_CACHE, WRITE_DELTA)
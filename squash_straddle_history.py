@@ -0,0 +1,249 @@
+# Append-only local history of the squash straddle report pivots, memory-mapped for trend queries
+
+# Standards
+import sys
+import os
+import json
+import datetime
+
+import numpy as np
+import pandas as pd
+
+################## CONSTANTS #######################################################################
+
+HISTORY_DIR = os.path.join(os.path.expanduser('~'), 'tz_data', 'squash_straddle')
+
+# One record per pivot cell per run.  Measure, row and column labels are codes into labels.json.
+CELL_DTYPE = np.dtype([('run', '<u4'), ('measure', '<u2'), ('row', '<u2'), ('col', '<u2'),
+                       ('value', '<f8')])
+
+# One record per run: when it was, and where its cells start in cells.bin
+RUN_DTYPE = np.dtype([('timestamp', '<i8'), ('first_cell', '<u8'), ('n_cells', '<u4')])
+
+CELLS_FILE_NAME = 'cells.bin'
+RUNS_FILE_NAME = 'runs.bin'
+LABELS_FILE_NAME = 'labels.json'
+
+################## FUNCTIONS: WRITE ################################################################
+
+
+def read_labels(history_dir=HISTORY_DIR):
+
+    try:
+        with open(os.path.join(history_dir, LABELS_FILE_NAME), 'r') as f:
+            return json.load(f)
+
+    except (IOError, ValueError):
+        return []
+
+
+def append_snapshot(pivot_dfs, timestamp=None, history_dir=HISTORY_DIR):
+
+    # Appends every cell of the run's pivot tables (one per measure, named by its index name)
+
+    timestamp = timestamp or datetime.datetime.now()
+
+    if not os.path.isdir(history_dir):
+        os.makedirs(history_dir)
+
+    labels = read_labels(history_dir)
+    label_codes = {label: code for code, label in enumerate(labels)}
+
+    def code(label):
+        if label not in label_codes:
+            label_codes[label] = len(labels)
+            labels.append(label)
+        return label_codes[label]
+
+    runs = read_runs(history_dir)
+
+    # the run's cells start where cells.bin ends, not where the last run's do: a write that died
+    # before its run record leaves cells no run points at.  A partly written record is padded out.
+    cells_path = os.path.join(history_dir, CELLS_FILE_NAME)
+    cells_bytes = os.path.getsize(cells_path) if os.path.isfile(cells_path) else 0
+
+    n_cells_before = -(-cells_bytes // CELL_DTYPE.itemsize)
+    padding = n_cells_before * CELL_DTYPE.itemsize - cells_bytes
+
+    cells = []
+
+    for pivot_df in pivot_dfs:
+
+        measure = code(str(pivot_df.index.name))
+        row_codes = [code(str(row)) for row in pivot_df.index]
+        col_codes = [code(str(col)) for col in pivot_df.columns]
+
+        values = pivot_df.values.astype(float)
+
+        block = np.empty(values.size, dtype=CELL_DTYPE)
+        block['run'] = len(runs)
+        block['measure'] = measure
+        block['row'] = np.repeat(row_codes, len(col_codes))
+        block['col'] = np.tile(col_codes, len(row_codes))
+        block['value'] = values.ravel()
+
+        cells.append(block)
+
+    cells = np.concatenate(cells) if cells else np.empty(0, dtype=CELL_DTYPE)
+
+    run = np.array([(int(pd.Timestamp(timestamp).value), n_cells_before, len(cells))],
+                   dtype=RUN_DTYPE)
+
+    # labels first, then cells, then the run record that makes them visible to readers
+    with open(os.path.join(history_dir, LABELS_FILE_NAME + '.tmp'), 'w') as f:
+        json.dump(labels, f)
+
+    os.replace(os.path.join(history_dir, LABELS_FILE_NAME + '.tmp'),
+               os.path.join(history_dir, LABELS_FILE_NAME))
+
+    with open(cells_path, 'ab') as f:
+        f.write(b'\0' * padding + cells.tobytes())
+
+    with open(os.path.join(history_dir, RUNS_FILE_NAME), 'ab') as f:
+        f.write(run.tobytes())
+
+################## FUNCTIONS: READ #################################################################
+
+
+def map_records(file_path, dtype):
+
+    # Memory-maps a file of records, nothing is read until the records are used
+
+    n_records = os.path.getsize(file_path) // dtype.itemsize if os.path.isfile(file_path) else 0
+
+    if n_records == 0:
+        return np.empty(0, dtype=dtype)
+
+    return np.memmap(file_path, dtype=dtype, mode='r', shape=(n_records,))
+
+
+def read_runs(history_dir=HISTORY_DIR):
+    return map_records(os.path.join(history_dir, RUNS_FILE_NAME), RUN_DTYPE)
+
+
+def run_cells(run_numbers, history_dir=HISTORY_DIR):
+
+    # Cells of the given runs, reading only their slices of cells.bin
+
+    runs = read_runs(history_dir)
+    cells = map_records(os.path.join(history_dir, CELLS_FILE_NAME), CELL_DTYPE)
+
+    return [cells[int(runs['first_cell'][n]):int(runs['first_cell'][n] + runs['n_cells'][n])]
+            for n in run_numbers]
+
+
+def cell_history(measure, row, col, last_n_runs=None, history_dir=HISTORY_DIR):
+
+    # One pivot cell across runs.  Ex: cell_history('ATMS_NEW', 'Grand Total', 'Green', 20)
+
+    labels = read_labels(history_dir)
+    runs = read_runs(history_dir)
+
+    if any(label not in labels for label in [measure, row, col]) or len(runs) == 0:
+        return pd.Series(dtype=float)
+
+    measure_code, row_code, col_code = labels.index(measure), labels.index(row), labels.index(col)
+
+    first_run = 0 if last_n_runs is None else max(0, len(runs) - last_n_runs)
+
+    timestamps, values = [], []
+
+    for n, cells in zip(range(first_run, len(runs)), run_cells(range(first_run, len(runs)),
+                                                               history_dir)):
+
+        hit = ((cells['measure'] == measure_code) & (cells['row'] == row_code)
+               & (cells['col'] == col_code))
+
+        if hit.any():
+            timestamps.append(pd.Timestamp(int(runs['timestamp'][n])))
+            values.append(float(cells['value'][hit][0]))
+
+    return pd.Series(values, index=pd.DatetimeIndex(timestamps, name='timestamp'), name=col)
+
+
+def snapshot(run_number=-1, history_dir=HISTORY_DIR):
+
+    # The pivot tables of one run, {measure: pivot df}, latest run by default
+
+    labels = read_labels(history_dir)
+    runs = read_runs(history_dir)
+
+    if len(runs) == 0:
+        return {}
+
+    run_number = run_number % len(runs)
+    cells = pd.DataFrame(np.asarray(run_cells([run_number], history_dir)[0]))
+
+    pivot_dfs = {}
+
+    for measure, measure_cells in cells.groupby('measure', sort=False):
+
+        pivot_df = measure_cells.pivot(index='row', columns='col', values='value')
+
+        # labels back in the order the run stored them
+        pivot_df = pivot_df.reindex(index=measure_cells['row'].unique(),
+                                    columns=measure_cells['col'].unique())
+        pivot_df.index = [labels[c] for c in pivot_df.index]
+        pivot_df.columns = [labels[c] for c in pivot_df.columns]
+        pivot_df.index.name = labels[measure]
+
+        pivot_dfs[labels[measure]] = pivot_df
+
+    return pivot_dfs
+
+
+def snapshot_delta(run_number=-1, history_dir=HISTORY_DIR):
+
+    # Change of every pivot cell versus the run before, {measure: delta df}.  Cells only in one
+    # of the two runs count from 0.
+
+    runs = read_runs(history_dir)
+
+    if len(runs) < 2:
+        return {}
+
+    run_number = run_number % len(runs)
+
+    current = snapshot(run_number, history_dir)
+    previous = snapshot(run_number - 1, history_dir)
+
+    delta_dfs = {}
+
+    for measure, current_df in current.items():
+
+        previous_df = previous.get(measure, pd.DataFrame())
+
+        delta_df = current_df.sub(previous_df, fill_value=0)
+        delta_df = delta_df.reindex(index=make_order(current_df.index, previous_df.index),
+                                    columns=make_order(current_df.columns, previous_df.columns))
+        delta_df.index.name = measure
+
+        delta_dfs[measure] = delta_df
+
+    return delta_dfs
+
+
+def make_order(current_labels, previous_labels):
+    # current labels in order, then any only the previous run had
+    return list(dict.fromkeys(list(current_labels) + list(previous_labels)))
+
+
+####### SCRIPT #####################################################################################
+
+
+if __name__ == '__main__':
+
+    # python -m tz_script.squash_straddle_history cell ATMS_NEW "Grand Total" Green 20
+    # python -m tz_script.squash_straddle_history delta
+    if sys.argv[1:2] == ['cell']:
+        measure, row, col = sys.argv[2:5]
+        last_n_runs = int(sys.argv[5]) if len(sys.argv) > 5 else None
+
+        print(cell_history(measure, row, col, last_n_runs).to_string())
+
+    elif sys.argv[1:2] == ['delta']:
+        for delta_df in snapshot_delta().values():
+            print(delta_df.to_string() + '\n')
+
+    else:
+        print('usage: squash_straddle_history cell <measure> <row> <col> [last_n_runs] | delta')
@@ -0,0 +1,127 @@
+# posView parsing of the Wedbush position check
+
+# Standards
+import datetime
+import os
+
+import pandas as pd
+import pytest
+
+# Locals
+from tz_script import email_wedbush_position_check
+
+################## FIXTURES ########################################################################
+
+POSVIEW = pd.DataFrame({'a_type': ['frm', 'frm', 'frm', 'tst', 'frm', 'frm'],
+                        'a_abr': ['NEW', 'NEW', 'NYCO', 'NEW', 'NEW', 'EXP'],
+                        'u_abr': ['EDZ6', 'EDZ6', 'EDH7', 'EDH7', 'EDM7', 'EDM7'],
+                        'm_abr': ['0317', '0317', 'H7', 'H7', 'M7', 'M7'],
+                        'x': ['97', '98', '97.5', '96', '', '97.25'],
+                        'pc': ['C', 'P', 'C', 'C', 'F', 'P'],
+                        'q': [100, -50, 25, 1, 7, 3]})
+
+
+@pytest.fixture
+def posview_path(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(email_wedbush_position_check, 'POS_CACHE_DIR', str(tmp_path / 'cache'))
+
+    path = tmp_path / 'posView.CSV'
+    POSVIEW.to_csv(str(path), index=False)
+
+    return str(path)
+
+################## TESTS ###########################################################################
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 2, 100])
+def test_column_types_do_not_depend_on_chunks(posview_path, monkeypatch, chunk_rows):
+
+    monkeypatch.setattr(email_wedbush_position_check, 'POS_READ_CHUNK_ROWS', chunk_rows)
+
+    columns = ['a_type', 'a_abr', 'u_abr', 'm_abr', 'x', 'pc', 'q']
+    tz_pos_df = email_wedbush_position_check.read_tz_positions(posview_path, columns)
+
+    # month codes stay text even in a chunk where they all read as numbers
+    assert list(tz_pos_df['m_abr']) == ['0317', '0317', 'H7', 'M7', 'M7']
+    assert tz_pos_df['x'].dtype == 'float64'
+    assert tz_pos_df['q'].dtype == 'int64'
+    assert list(tz_pos_df['q']) == [100, -50, 25, 7, 3]
+
+
+def set_modified(path, day, hour):
+
+    modified = datetime.datetime(2026, 9, day, hour).timestamp()
+    os.utime(path, (modified, modified))
+
+
+@pytest.fixture
+def posview_dir(tmp_path, monkeypatch):
+
+    # posViews of the 14th evening, 15th morning, 15th evening and 16th morning
+    monkeypatch.setattr(email_wedbush_position_check, 'TZ_FILE_TEMPLATE',
+                        str(tmp_path / 'posView*.CSV'))
+
+    for name, day, hour in [('a', 14, 18), ('b', 15, 7), ('c', 15, 18), ('d', 16, 7)]:
+        path = tmp_path / ('posView_%s.CSV' % name)
+        path.write_text('')
+        set_modified(str(path), day, hour)
+
+    return tmp_path
+
+
+@pytest.mark.parametrize('downloaded_day, downloaded_hour, expected', [
+    (15, 8, 'posView_b.CSV'),   # the morning run after the 14th
+    (15, 19, 'posView_c.CSV'),  # downloaded later that day
+    (20, 8, 'posView_b.CSV'),   # downloaded later, latest posView at the 15th's run time
+])
+def test_posview_is_the_latest_at_the_next_morning_run(posview_dir, downloaded_day,
+                                                        downloaded_hour, expected):
+
+    wb_pos_fn = str(posview_dir / 'WEDPOS_20260914.csv')
+    open(wb_pos_fn, 'w').close()
+    set_modified(wb_pos_fn, downloaded_day, downloaded_hour)
+
+    tz_pos_fn = email_wedbush_position_check.tz_pos_file_for_day(
+        datetime.datetime(2026, 9, 14), wb_pos_fn)
+
+    assert os.path.basename(tz_pos_fn) == expected
+
+
+def test_no_posview_since_the_trade_date(posview_dir):
+
+    wb_pos_fn = str(posview_dir / 'WEDPOS_20260920.csv')
+    open(wb_pos_fn, 'w').close()
+    set_modified(wb_pos_fn, 21, 8)
+
+    assert email_wedbush_position_check.tz_pos_file_for_day(
+        datetime.datetime(2026, 9, 20), wb_pos_fn) is None
+
+
+@pytest.mark.parametrize('hash_compare, engine', [(False, 'legacy'), (True, 'hash')])
+def test_backfill_day_uses_the_run_engine(monkeypatch, hash_compare, engine):
+
+    module = email_wedbush_position_check
+    title = list(module.COMPARE_GROUPS)[0]
+    engines = []
+
+    def compared(name):
+        engines.append(name)
+        return {title: pd.DataFrame({'q': [1, 2]})}
+
+    monkeypatch.setattr(module, 'extract_tz_dfs', lambda fn: [None])
+    monkeypatch.setattr(module, 'filter_wb_position', lambda fn: [None])
+    monkeypatch.setattr(module, 'legacy_compare_positions', lambda *args: compared('legacy'))
+    monkeypatch.setattr(module, 'compare_positions',
+                        lambda *args: (compared('hash'),
+                                       pd.DataFrame({'breaks': [2]},
+                                                    index=pd.Index([title], name='group'))))
+
+    breaks, break_counts = module.reconcile_day(datetime.datetime(2026, 9, 14),
+                                                'WEDPOS_20260914.csv', 'posView.CSV',
+                                                hash_compare)
+
+    assert engines == [engine]
+    assert list(breaks['group']) == [title, title]
+    assert list(break_counts['group']) == [title]
+    assert list(break_counts['breaks']) == [2]
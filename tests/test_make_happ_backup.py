@@ -0,0 +1,91 @@
+# Parallel zip of the Happ backup bins, read back through Python's own zip reader, and the local
+# bin folders kept by incremental backups
+
+# Standards
+import os
+import zipfile
+
+import pytest
+
+# Locals
+from tz_script import make_happ_backup
+
+################## FIXTURES ########################################################################
+
+
+@pytest.fixture
+def bin_paths(tmp_path):
+
+    # bins of repetitive and random bytes, one empty and one over several read chunks
+    bins_dir = tmp_path / 'bins'
+    bins_dir.mkdir()
+
+    contents = {'empty.bin': b'',
+                'small.bin': b'happ' * 1000,
+                'random.bin': os.urandom(100000),
+                'large.bin': (b'month table row ' * 1000 + os.urandom(1000)) *
+                             (3 * make_happ_backup.ARCHIVE_CHUNK_BYTES // 17000)}
+
+    for name, content in contents.items():
+        (bins_dir / name).write_bytes(content)
+
+    return {str(bins_dir / name): content for name, content in contents.items()}
+
+################## TESTS ###########################################################################
+
+
+def test_archive_reads_back_as_the_bins(bin_paths, tmp_path):
+
+    zip_dir = tmp_path / 'dropbox'
+    zip_dir.mkdir()
+    zip_path = str(zip_dir / 'backup.zip')
+
+    assert make_happ_backup.archive_bin_files(list(bin_paths), zip_path, max_workers=2)
+
+    with zipfile.ZipFile(zip_path) as zf:
+
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == sorted(os.path.basename(path) for path in bin_paths)
+
+        for path, content in bin_paths.items():
+            assert zf.read(os.path.basename(path)) == content
+            assert zf.getinfo(os.path.basename(path)).compress_type == zipfile.ZIP_DEFLATED
+
+    # the deflate streams were written elsewhere, only the zip is left next to it
+    assert os.listdir(str(zip_dir)) == ['backup.zip']
+
+
+def test_deflated_member_appends_after_regular_members(bin_paths, tmp_path):
+
+    path, content = max(bin_paths.items(), key=lambda item: len(item[1]))
+    member_path = str(tmp_path / 'member.deflate')
+
+    zinfo, _ = make_happ_backup.compress_bin_file(path, member_path)
+
+    zip_path = str(tmp_path / 'mixed.zip')
+
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('before.txt', b'written by zipfile')
+        make_happ_backup.write_deflated_member(zf, zinfo, member_path)
+        zf.writestr('after.txt', b'also written by zipfile')
+
+    with zipfile.ZipFile(zip_path) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ['before.txt', os.path.basename(path), 'after.txt']
+        assert zf.read(os.path.basename(path)) == content
+
+
+def test_prune_keeps_the_latest_local_backups(tmp_path):
+
+    names = ['2026_10_16_0900_happDb', '2026_10_17_0900_happDb', '2026_10_17_1500_happDb']
+
+    for name in names:
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'tbl00.bin').write_bytes(b'bin')
+
+    (tmp_path / 'happ_chunks').mkdir()
+
+    make_happ_backup.prune_local_backups(str(tmp_path), n_kept=2)
+
+    assert sorted(os.listdir(str(tmp_path))) == ['2026_10_17_0900_happDb',
+                                                 '2026_10_17_1500_happDb', 'happ_chunks']
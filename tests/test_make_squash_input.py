@@ -0,0 +1,133 @@
+# Batch ED strikes against the scalar tz_bls solver they replace, and the snapshot table loader
+
+# Standards
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Locals
+from tz_calculation import tz_bls
+from tz_script import make_squash_input
+
+################## FIXTURES ########################################################################
+
+# squash_input deltas, puts negative
+DELTAS = [-0.45, -0.25, -0.10, -0.05, 0.05, 0.10, 0.25, 0.45]
+
+# (underlying price, vol as a decimal, years to expiry), fronts to long midcurves
+ROWS = [(99.75, 0.60, 0.05),
+        (98.20, 0.35, 0.25),
+        (97.50, 0.25, 1.00),
+        (96.80, 0.18, 2.50),
+        (97.90, 0.90, 0.02)]
+
+################## TESTS ###########################################################################
+
+
+@pytest.mark.parametrize('row', range(len(ROWS)))
+def test_batch_strikes_match_tz_bls(row):
+
+    u_prc, vol, t_exp = (np.array([v]) for v in ROWS[row])
+
+    strikes = make_squash_input.eu_opt_strikes_ED(u_prc, DELTAS, vol, t_exp)
+    expected = [tz_bls.eu_opt_strike_ED(u_prc[0], delta, vol[0], t_exp[0], R=None, Q=None)[0]
+                for delta in DELTAS]
+
+    assert np.allclose(strikes[0], expected, rtol=0, atol=make_squash_input.STRIKE_CHECK_TOLERANCE)
+
+
+def test_check_strikes_reports_a_bad_row():
+
+    u_prc, vol, t_exp = (np.array(col) for col in zip(*ROWS))
+
+    strikes = make_squash_input.eu_opt_strikes_ED(u_prc, DELTAS, vol, t_exp)
+    strikes[3, 2] += 0.01
+
+    rows = make_squash_input.spot_check_rows(len(ROWS), len(ROWS))
+    worst = make_squash_input.check_strikes(u_prc, DELTAS, vol, t_exp, strikes, rows)
+
+    assert worst == pytest.approx(0.01, abs=1e-6)
+
+
+MONTH_TABLE = pd.DataFrame({'u_abr': ['EDH7', 'SH7', 'EDM7', 'FF1', 'EDU7'],
+                            'm_abr': ['H7', 'H7', 'M7', 'F7', 'U7'],
+                            'skew_price': [98.1, 98.0, 97.9, 99.0, 97.7],
+                            'slope_vatm': [20.0, 21.0, 22.0, 10.0, 23.0],
+                            'dexp': ['2027-03-15', '2027-03-15', '2027-06-14', '2027-01-15',
+                                     '2027-09-13'],
+                            'unused': [1, 2, 3, 4, 5]})
+
+
+@pytest.fixture
+def snapshot_dirs(tmp_path, monkeypatch):
+
+    # an empty tenTables dir and a local cache dir for the loader
+    monkeypatch.setattr(make_squash_input, 'SNAPSHOT_DIR_TEMPLATE',
+                        str(tmp_path / 'tenTables' / '*'))
+    monkeypatch.setattr(make_squash_input, 'SNAPSHOT_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(make_squash_input, 'SNAPSHOT_READ_CHUNK_ROWS', 2)
+
+    (tmp_path / 'tenTables').mkdir()
+
+    return tmp_path
+
+
+def test_snapshot_table_is_read_projected_filtered_and_cached(snapshot_dirs, monkeypatch):
+
+    snapshot_dir = snapshot_dirs / 'tenTables' / 'snapshot'
+    snapshot_dir.mkdir()
+    MONTH_TABLE.to_csv(str(snapshot_dir / 'month.csv'), index=False)
+
+    def whole_db():
+        raise AssertionError('the whole cleaned DB was loaded')
+
+    monkeypatch.setattr(make_squash_input.tz_happ_tables, 'get_last_cleaned_db_dic', whole_db)
+
+    expected = make_squash_input.select_rows_cols(MONTH_TABLE, make_squash_input.MONTH_COLS,
+                                                  make_squash_input.MONTH_PREFIXES)
+
+    for _ in range(2):
+        m_df = make_squash_input.load_snapshot_table('month', make_squash_input.MONTH_COLS,
+                                                     make_squash_input.MONTH_PREFIXES)
+
+        pd.testing.assert_frame_equal(m_df, expected.reset_index(drop=True))
+
+    assert len(os.listdir(str(snapshot_dirs / 'cache'))) == 1
+
+
+def test_no_snapshot_table_loads_the_cleaned_db(snapshot_dirs, monkeypatch):
+
+    monkeypatch.setattr(make_squash_input.tz_happ_tables, 'get_last_cleaned_db_dic',
+                        lambda: {'month': MONTH_TABLE})
+
+    m_df = make_squash_input.load_snapshot_table('month', make_squash_input.MONTH_COLS,
+                                                 make_squash_input.MONTH_PREFIXES)
+
+    assert list(m_df['u_abr']) == ['EDH7', 'EDM7', 'EDU7']
+
+
+@pytest.mark.parametrize('corruption', [b'', b'garbage', 'truncated', 'other type'])
+def test_unreadable_strike_cache_starts_empty(tmp_path, corruption):
+
+    cache_path = str(tmp_path / 'squash_strikes.pkl')
+
+    strike_cache = make_squash_input.load_strike_cache(cache_path)
+    u_prc, vol, t_exp = (np.array(col) for col in zip(*ROWS))
+    make_squash_input.cached_eu_opt_strikes_ED(u_prc, DELTAS, vol, t_exp, strike_cache)
+    make_squash_input.save_strike_cache(strike_cache, cache_path)
+
+    with open(cache_path, 'rb') as f:
+        data = f.read()
+
+    if corruption == 'truncated':
+        corruption = data[:len(data) // 2]
+    elif corruption == 'other type':
+        corruption = pickle.dumps(['not', 'a', 'cache'])
+
+    with open(cache_path, 'wb') as f:
+        f.write(corruption)
+
+    assert len(make_squash_input.load_strike_cache(cache_path)['entries']) == 0
@@ -0,0 +1,88 @@
+# Equivalence of the vectorized month/group codes with the original row-wise ones
+
+# Standards
+import pandas as pd
+import pytest
+
+# Locals
+from tz_script import make_squash_straddle
+from tz_script.make_squash_straddle import MC_NAME_DICT, MC_DIFF_DICT
+
+################## REFERENCE: ROW-WISE CODES #######################################################
+
+
+def reference_g_code(df_row):
+
+    if df_row['is_front']:
+        return 'Front'
+
+    else:
+        return MC_NAME_DICT[df_row['happ_g_code']]
+
+
+def reference_exp_my_code(df_row):
+
+    if df_row['is_front']:
+        return df_row['exp_m_code'] + str(df_row['u_yr'])
+
+    else:
+        int_year = int(df_row['u_yr']) - MC_DIFF_DICT[df_row['happ_g_code']]
+        return df_row['exp_m_code'] + str(int_year % 10)
+
+################## FIXTURES ########################################################################
+
+# Happ month codes, underlying/expiry: fronts are 4 characters, midcurves carry the group before
+# the expiry month.  Ex: Z6/Z, U8/GU
+FRONTS = ['Z6/Z', 'H7/H', 'M8/M', 'U9/U', 'Z0/Z', 'H7/F', 'Z6/V']
+
+# every midcurve group on one underlying, quarterly and serial expiries
+MIDCURVES = ['U9/%sU' % g for g in MC_DIFF_DICT] + ['Z9/%sV' % g for g in MC_DIFF_DICT]
+
+# underlying years that go below 0 once the group's offset is taken off
+YEAR_WRAPS = ['H0/SH', 'M0/GF', 'U1/BU', 'Z2/FX', 'H4/IH', 'M3/IM', 'U0/IQ']
+
+FIXTURES = {'fronts': FRONTS,
+            'midcurves': MIDCURVES,
+            'year_wraps': YEAR_WRAPS,
+            'all': FRONTS + MIDCURVES + YEAR_WRAPS}
+
+
+def helper_columns(month_codes):
+
+    # the grouping columns as make_squash_straddle builds them from the report index
+    dat = pd.DataFrame(index=pd.Index(month_codes))
+
+    dat['u_yr'] = dat.index.map(lambda x: x[1:2])
+    dat['is_front'] = dat.index.map(lambda x: len(x) == 4)
+    dat['happ_g_code'] = dat.index.map(lambda x: x[3])
+    dat['exp_m_code'] = dat.index.map(lambda x: x[-1])
+
+    return dat
+
+################## TESTS ###########################################################################
+
+
+@pytest.mark.parametrize('fixture', sorted(FIXTURES))
+def test_codes_match_row_wise(fixture):
+
+    dat = helper_columns(FIXTURES[fixture])
+
+    expected_g = dat.apply(reference_g_code, axis=1)
+    expected_my = dat.apply(reference_exp_my_code, axis=1)
+
+    assert list(make_squash_straddle.get_g_codes(dat)) == list(expected_g)
+    assert list(make_squash_straddle.get_exp_my_codes(dat)) == list(expected_my)
+
+
+def test_year_wrap_fixtures_wrap():
+
+    dat = helper_columns(YEAR_WRAPS)
+    mc_years = dat['u_yr'].astype(int) - dat['happ_g_code'].map(MC_DIFF_DICT)
+
+    assert (mc_years < 0).all()
+
+
+def test_unknown_group_raises():
+
+    with pytest.raises(KeyError):
+        make_squash_straddle.get_g_codes(helper_columns(['U9/XU']))
@@ -0,0 +1,93 @@
+# Hash join reconciliation against a plain outer merge, and its key normalization
+
+# Standards
+import numpy as np
+import pandas as pd
+import pytest
+
+# Locals
+from tz_script import position_recon
+
+################## FIXTURES ########################################################################
+
+KEY_COLS = ['u_abr', 'm_abr', 'x', 'pc']
+
+SPLITS = {'NEW': {'acct': ['NEW']}, 'NYCO': {'acct': ['NYCO']}}
+GROUPS = {'Overall': None, 'NEW': ['NEW'], 'NYCO': ['NYCO']}
+
+
+def tz_positions():
+
+    return pd.DataFrame({'acct': ['NEW', 'NEW', 'NYCO', 'NYCO', 'NEW'],
+                         'u_abr': ['EDZ6', 'EDZ6', 'EDZ6', 'EDH7', 'EDH7'],
+                         'm_abr': ['Z6', 'Z6', 'Z6', 'H7', 'H7'],
+                         'x': [97.5, 97.625, 97.5, 98.0, np.nan],
+                         'pc': ['C', 'P', 'C', 'C', 'F'],
+                         'q': [100, -50, 25, 10, 7]})
+
+
+def wb_positions():
+
+    # strikes as Wedbush text, padded, the future without one
+    return pd.DataFrame({'acct': ['NEW', 'NEW', 'NYCO', 'NYCO', 'NEW', 'NEW'],
+                         'u_abr': ['EDZ6', 'EDZ6 ', 'EDZ6', 'EDH7', 'EDH7', 'EDM7'],
+                         'm_abr': ['Z6', 'Z6', 'Z6', 'H7', 'H7', 'M7'],
+                         'x': ['97.50', '97.625', '97.5', '98', None, '98.25'],
+                         'pc': ['C', 'P', 'C', 'C', 'F', 'P'],
+                         'q': [100, -40, 25, 12, 7, 3]})
+
+################## REFERENCE: OUTER MERGE ##########################################################
+
+
+def reference_break_keys(tz_df, wb_df, accounts):
+
+    # Keys whose summed q differs, from an outer merge of the sides with strikes as numbers
+    sides = []
+
+    for pos_df in [tz_df, wb_df]:
+
+        pos_df = pos_df if accounts is None else pos_df[pos_df['acct'].isin(accounts)]
+        pos_df = pos_df.assign(u_abr=pos_df['u_abr'].str.strip(),
+                               x=pd.to_numeric(pos_df['x']))
+
+        sides.append(pos_df.groupby(KEY_COLS, dropna=False)['q'].sum())
+
+    merged = pd.concat(sides, axis=1, keys=['tz', 'wb']).fillna(0)
+    merged = merged[merged['tz'] != merged['wb']].reset_index()
+
+    return position_recon.break_keys(merged, KEY_COLS)
+
+################## TESTS ###########################################################################
+
+
+@pytest.mark.parametrize('group', sorted(GROUPS))
+def test_breaks_match_outer_merge(group):
+
+    breaks, _ = position_recon.reconcile(tz_positions(), wb_positions(), KEY_COLS, ['q'], [0],
+                                         SPLITS, SPLITS, GROUPS)
+
+    expected = reference_break_keys(tz_positions(), wb_positions(), GROUPS[group])
+
+    assert position_recon.break_keys(breaks[group], KEY_COLS) == expected
+
+
+def test_float_and_text_strikes_are_one_key():
+
+    tz_df = tz_positions().iloc[[0]]
+    wb_df = wb_positions().iloc[[0]]
+
+    breaks, break_counts = position_recon.reconcile(tz_df, wb_df, KEY_COLS, ['q'], [0],
+                                                    SPLITS, SPLITS, GROUPS)
+
+    assert len(breaks['Overall']) == 0
+    assert break_counts.loc['Overall', 'keys'] == 1
+
+
+def test_normalized_keys():
+
+    assert list(position_recon.normalized_keys(np.array([97.5, '97.50', 98], dtype=object))) == \
+        [97.5, 97.5, 98.0]
+
+    mixed = position_recon.normalized_keys(np.array(['Z6 ', 7, None], dtype=object))
+
+    assert list(mixed[:2]) == ['Z6', '7'] and pd.isna(mixed[2])
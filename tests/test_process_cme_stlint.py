@@ -0,0 +1,255 @@
+# Equivalence of the vectorized settles.txt pipeline with the original row-wise one, and the
+# settles delta against a previously written settles.txt
+
+# Standards
+import pandas as pd
+import pytest
+
+from csv import QUOTE_NONE
+
+# Locals
+from tz_interface import tz_cme
+from tz_script import process_cme_stlint, bench_process_cme_stlint
+
+################## REFERENCE: ROW-WISE PIPELINE ####################################################
+
+
+def reference_stlint_lines(lines):
+
+    data_nested_lists = []
+    key = ''
+
+    for line in lines:
+
+        if len(line.strip()) == 0:
+            continue
+
+        tokens = [t for t in line.split() if len(t.strip()) > 0]
+
+        if tokens[0].rstrip(' ') == 'TOTAL':
+            key = ''
+
+        if key != '':
+
+            if key == 'ED':
+                col = [key, tokens[0], 0]
+                data_nested_lists.append(col + tokens)
+
+            else:
+                if (len(tokens[0]) > 3) and ((tokens[0][:1] == '9') or (tokens[0][:1] == '1')):
+                    data_nested_lists.append(col + tokens)
+                else:
+                    key = ''
+
+        if tokens[0] in tz_cme.cme_stlint_lst:
+            key = tokens[0]
+            col = [tokens[0], tokens[1], tokens[len(tokens) - 1]]
+
+    return pd.DataFrame(data_nested_lists)
+
+
+def reference_weekly(data_df_row):
+
+    if data_df_row['Prod'] in ['S', 'G', 'B', 'F', 'I']:
+
+        if data_df_row['Year'] == data_df_row['undYear']:
+            return '"' + data_df_row['Prod'] + '"'
+
+        else:
+            return '"' + data_df_row['Prod'] + data_df_row['Month'] + '"'
+
+    else:
+        return '"' + data_df_row['Prod'] + '"'
+
+
+def reference_midcurve_underlying(data_df_row):
+
+    pr = data_df_row['Prod']
+    yr = data_df_row['Year']
+
+    if pr in ['S', 'S1', 'S2', 'S3', 'S4', 'S5']:
+        return yr + 1
+
+    elif pr in ['G', 'G1', 'G2', 'G3', 'G4', 'G5']:
+        return yr + 2
+
+    elif pr in ['B', 'B1', 'B2', 'B3', 'B4', 'B5']:
+        return yr + 3
+
+    elif pr == 'F':
+        return yr + 4
+
+    elif pr == 'I':
+        return yr + 5
+
+    return yr
+
+
+def reference_settles_txt(lines, output_path):
+
+    # The original run() from the parsed lines to the written file
+
+    data_raw_df = reference_stlint_lines(lines)
+
+    data_raw_df['mon'] = data_raw_df[1].str[0:3]
+    data_raw_df['yr'] = data_raw_df[1].str[3:5].astype(int)
+
+    data_df = data_raw_df[[0, 'mon', 'yr', 2, 3, 8]].copy()
+    data_df.columns = ['Prod', 'Month', 'Year', 'CP', 'Strike', 'Price']
+
+    swap_dict = {v: k for k, v in tz_cme.o_ed_midcurve.items()}
+    data_df['Prod'] = data_df['Prod'].replace(swap_dict)
+    data_df['Month'] = data_df['Month'].replace(tz_cme.cme_stlint_month_dic)
+
+    data_df['undYear'] = data_df.apply(reference_midcurve_underlying, axis=1)
+
+    filt_ZE = data_df['Prod'] == 'ZE'
+    data_df.loc[filt_ZE, 'Prod'] = data_df[filt_ZE]['Month']
+
+    data_df['undMonth'] = data_df['Month'].replace(tz_cme.cme_ed_expiration_to_underlying_dict)
+    filt_ED = data_df['Prod'] == 'ED'
+    data_df.loc[filt_ED, 'undMonth'] = data_df[filt_ED]['Month']
+
+    data_df['Underlying'] = '"ED' + data_df['undMonth'].map(str) + data_df['undYear'].map(str) + '"'
+
+    data_df.loc[filt_ED, 'Prod'] = '""'
+
+    data_df['HappProd'] = data_df.apply(reference_weekly, axis=1)
+
+    data_df['CP'] = data_df['CP'].replace({'CALL': '"C"', 'PUT': '"P"', 0: '" "'})
+
+    data_df.loc[data_df['Prod'] == '""', 'Strike'] = 1000
+    data_df['X'] = (round(0.08 * data_df['Strike'].astype(int)) / 8).map(
+        process_cme_stlint.str_strip_right)
+    data_df.loc[data_df['Prod'] == '""', 'X'] = 0
+
+    data_df['Price'] = data_df['Price'].map(process_cme_stlint.str_strip_right)
+
+    data_df[['Underlying', 'HappProd', 'X', 'CP', 'Price']].to_csv(
+        output_path, sep='\t', encoding='utf-8', index=False, header=False, quoting=QUOTE_NONE)
+
+################## FIXTURES ########################################################################
+
+# Happ midcurve codes covered, their stlint codes come from tz_cme
+MIDCURVE_PRODS = ['S', 'G', 'B', 'F', 'I']
+WEEKLY_PRODS = ['S1', 'G1']
+
+# settles as CME writes them: futures in full, options under 1 without the leading 0
+OPTION_SETTLES = ['.0025', '.0150', '.1225', '1.0000', '12.5000', '.0000']
+
+
+def stlint_section(stlint_prod, contract, cp, strikes):
+
+    lines = ['%s %s CME EURODOLLAR OPTIONS %s' % (stlint_prod, contract, cp)]
+
+    for i, strike in enumerate(strikes):
+        settle = OPTION_SETTLES[i % len(OPTION_SETTLES)]
+        lines.append('%d  ---- ---- ---- ---- %s +.0025 0 %s 0 0' % (strike, settle, settle))
+
+    return lines + ['TOTAL 10 20', '']
+
+
+def stlint_lines(option_prods, contracts):
+
+    lines = ['BUSINESS DATE: 10/17/26', '', 'ED  CME EURODOLLAR FUTURES']
+
+    for i, contract in enumerate(['DEC26', 'MAR27', 'JUN27', 'SEP27', 'DEC27', 'MAR28']):
+        settle = '98.%04d' % (1200 + 25 * i)
+        lines.append('%s  ---- ---- ---- ---- %s +.0050 12345 %s 1000 2000' % (contract, settle,
+                                                                               settle))
+
+    lines += ['TOTAL  1 2 3', '']
+
+    strikes = [9700, 9712, 9725, 9737, 9750, 9762, 9775, 10000]
+
+    for stlint_prod in option_prods:
+        for contract in contracts:
+            for cp in ['CALL', 'PUT']:
+                lines += stlint_section(stlint_prod, contract, cp, strikes)
+
+    return lines
+
+
+def stlint_codes(happ_prods):
+    return [tz_cme.o_ed_midcurve[p] for p in happ_prods if p in tz_cme.o_ed_midcurve]
+
+
+FIXTURES = {
+    'ed_futures': stlint_lines([], []),
+    # fronts, serial months included (JAN is also the front F that is not a gold midcurve)
+    'ze_fronts': stlint_lines(['ZE'], ['JAN27', 'FEB27', 'MAR27', 'APR27', 'JUN27', 'OCT27']),
+    'weeklys': stlint_lines(stlint_codes(WEEKLY_PRODS), ['JAN27', 'MAR27', 'NOV27']),
+    'midcurves': stlint_lines(stlint_codes(MIDCURVE_PRODS), ['JAN27', 'MAR27', 'AUG27', 'DEC27']),
+    'all': stlint_lines(['ZE'] + stlint_codes(MIDCURVE_PRODS + WEEKLY_PRODS),
+                        ['JAN27', 'MAR27', 'SEP27', 'DEC29'])}
+
+################## TESTS ###########################################################################
+
+
+@pytest.mark.parametrize('fixture', sorted(FIXTURES))
+def test_settles_txt_matches_row_wise_pipeline(fixture, tmp_path):
+
+    lines = FIXTURES[fixture]
+
+    reference_path = tmp_path / 'reference_settles.txt'
+    reference_settles_txt([line + '\n' for line in lines], str(reference_path))
+
+    output_path = tmp_path / 'settles.txt'
+    settle_df = process_cme_stlint.process_stlint_lines(line + '\n' for line in lines)
+    process_cme_stlint.write_settles(process_cme_stlint.transform_settles(settle_df),
+                                     str(output_path))
+
+    expected = reference_path.read_text(encoding='utf-8').splitlines()
+    assert output_path.read_text(encoding='utf-8').splitlines() == expected
+    assert len(expected) > 0
+
+
+def test_fixtures_cover_leading_dot_settles():
+
+    # the settle form that float parsing used to rewrite
+    settles = [line.split()[5] for line in FIXTURES['all'] if line[:1] in ('9', '1')]
+
+    assert any(settle.startswith('.') for settle in settles)
+
+
+def synthetic_settles(scale=2):
+
+    # settles.txt columns of the benchmark's stlint, which repeats weekly keys across months
+    lines = bench_process_cme_stlint.iter_synthetic_stlint(scale)
+    settle_df = process_cme_stlint.process_stlint_lines(line + '\n' for line in lines)
+
+    return process_cme_stlint.transform_settles(settle_df)
+
+
+def test_unchanged_rerun_gives_empty_delta(tmp_path):
+
+    settles_df = synthetic_settles()
+    assert settles_df.duplicated(process_cme_stlint.SETTLES_KEY_COLUMNS).any()
+
+    settles_path = str(tmp_path / 'settles.txt')
+    process_cme_stlint.write_settles(settles_df, settles_path)
+
+    previous = process_cme_stlint.read_settles(settles_path)
+    delta_df, summary = process_cme_stlint.settles_delta(settles_df, previous)
+
+    assert len(delta_df) == 0
+    assert summary == {'added': 0, 'changed': 0, 'unchanged': len(settles_df), 'removed': 0}
+
+
+def test_delta_of_one_repeated_key_settle(tmp_path):
+
+    settles_df = synthetic_settles()
+
+    settles_path = str(tmp_path / 'settles.txt')
+    process_cme_stlint.write_settles(settles_df, settles_path)
+
+    # the later month of a weekly key shared by two months moves
+    repeated = settles_df.index[settles_df.duplicated(process_cme_stlint.SETTLES_KEY_COLUMNS)]
+    moved_df = settles_df.copy()
+    moved_df.loc[repeated[0], 'Price'] = '9.9975'
+
+    previous = process_cme_stlint.read_settles(settles_path)
+    delta_df, summary = process_cme_stlint.settles_delta(moved_df, previous)
+
+    assert list(delta_df.index) == [repeated[0]]
+    assert summary['changed'] == 1 and summary['added'] == 0 and summary['removed'] == 0
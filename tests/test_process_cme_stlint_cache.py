@@ -0,0 +1,161 @@
+# Parsed stlint cache: remote stat and content hash hits, LRU eviction, corrupt entries, against
+# temp dirs and a local FTP stand-in for CME
+
+# Standards
+import os
+import socket
+import threading
+
+import pandas as pd
+import pytest
+
+# Locals
+from tz_script import process_cme_stlint
+
+################## FIXTURES ########################################################################
+
+STLINT_LINES = ['ED CME EURODOLLAR FUTURES',
+                'DEC26  ---- ---- ---- ---- 98.1250 +.0050 12345 98.1200 1000 2000',
+                'TOTAL 1 2 3',
+                '',
+                'E0 MAR27 CME EURODOLLAR OPTIONS CALL',
+                '9750  ---- ---- ---- ---- .0150 +.0025 0 .0125 0 0',
+                'TOTAL 10 20']
+
+
+def settle_table():
+    return process_cme_stlint.process_stlint_lines(line + '\n' for line in STLINT_LINES)
+
+
+def store(cache_dir, n, max_entries=process_cme_stlint.STLINT_CACHE_MAX_ENTRIES):
+
+    # caches the table under stat (n, 'mtime n') and hash 'hash n'
+    process_cme_stlint.cache_store((n, 'mtime%d' % n), 'hash%d' % n, settle_table(),
+                                   str(cache_dir), max_entries)
+
+
+@pytest.fixture
+def ftp_server(tmp_path):
+
+    # Anonymous local FTP serving settle/stlint, yields (host, port, stlint path)
+    pyftpdlib_servers = pytest.importorskip('pyftpdlib.servers')
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+
+    (tmp_path / 'settle').mkdir()
+    stlint_path = tmp_path / 'settle' / 'stlint'
+    stlint_path.write_text('\n'.join(STLINT_LINES) + '\n')
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(str(tmp_path))
+
+    handler = type('StandInHandler', (FTPHandler,), {'authorizer': authorizer})
+    server = pyftpdlib_servers.FTPServer(('127.0.0.1', 0), handler)
+
+    thread = threading.Thread(target=server.serve_forever, kwargs={'timeout': 0.1})
+    thread.start()
+
+    try:
+        yield '127.0.0.1', server.address[1], stlint_path
+
+    finally:
+        server.close_all()
+        thread.join()
+
+################## TESTS ###########################################################################
+
+
+def test_stat_hit(tmp_path):
+
+    store(tmp_path, 1)
+
+    settle_df = process_cme_stlint.cache_lookup(remote_stat=(1, 'mtime1'), cache_dir=str(tmp_path))
+
+    pd.testing.assert_frame_equal(settle_df, settle_table())
+    assert process_cme_stlint.cache_lookup(remote_stat=(2, 'mtime2'),
+                                           cache_dir=str(tmp_path)) is None
+
+
+def test_hash_hit_under_a_new_stat(tmp_path):
+
+    store(tmp_path, 1)
+
+    assert process_cme_stlint.cache_lookup(remote_stat=(1, 'republished'),
+                                           cache_dir=str(tmp_path)) is None
+    assert process_cme_stlint.cache_lookup(content_hash='hash1',
+                                           cache_dir=str(tmp_path)) is not None
+
+
+def test_lru_eviction(tmp_path):
+
+    store(tmp_path, 1, max_entries=2)
+    store(tmp_path, 2, max_entries=2)
+
+    # using the first makes the second the least recently used
+    assert process_cme_stlint.cache_lookup(content_hash='hash1', cache_dir=str(tmp_path)) is not None
+
+    store(tmp_path, 3, max_entries=2)
+
+    held = sorted(e['sha256'] for e in process_cme_stlint.read_cache_index(str(tmp_path)))
+
+    assert held == ['hash1', 'hash3']
+    assert not os.path.isfile(os.path.join(str(tmp_path), 'hash2.pkl'))
+
+
+@pytest.mark.parametrize('corruption', [b'', b'not a pickle', None])
+def test_corrupt_entry_is_dropped_and_skipped(tmp_path, corruption):
+
+    # two entries for the same content, the newer one unreadable
+    store(tmp_path, 1)
+    store(tmp_path, 2)
+
+    entries = process_cme_stlint.read_cache_index(str(tmp_path))
+    entries[1]['sha256'] = entries[0]['sha256'] = 'same'
+    process_cme_stlint.write_cache_index(entries, str(tmp_path))
+
+    bad_path = os.path.join(str(tmp_path), entries[0]['file'])
+
+    if corruption is None:
+        with open(bad_path, 'rb') as f:
+            data = f.read()
+        corruption = data[:len(data) // 2]  # truncated
+
+    with open(bad_path, 'wb') as f:
+        f.write(corruption)
+
+    settle_df = process_cme_stlint.cache_lookup(content_hash='same', cache_dir=str(tmp_path))
+
+    pd.testing.assert_frame_equal(settle_df, settle_table())
+    assert [e['file'] for e in process_cme_stlint.read_cache_index(str(tmp_path))] == \
+        [entries[1]['file']]
+
+
+def test_remote_stat_from_local_ftp(ftp_server, tmp_path):
+
+    host, port, stlint_path = ftp_server
+
+    remote_stat = process_cme_stlint.stlint_remote_stat(host=host, port=port)
+
+    assert remote_stat[0] == os.path.getsize(str(stlint_path))
+
+    # a rerun against the same remote file is a stat hit
+    store_dir = str(tmp_path / 'cache')
+    process_cme_stlint.cache_store(remote_stat, 'hash', settle_table(), store_dir)
+
+    assert process_cme_stlint.cache_lookup(remote_stat=process_cme_stlint.stlint_remote_stat(
+        host=host, port=port), cache_dir=store_dir) is not None
+
+
+def test_remote_stat_times_out_on_a_stalled_server():
+
+    # accepts the connection but never sends the FTP greeting
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+
+    try:
+        assert process_cme_stlint.stlint_remote_stat(host='127.0.0.1',
+                                                     port=listener.getsockname()[1],
+                                                     timeout=0.5) is None
+    finally:
+        listener.close()